@@ -0,0 +1,67 @@
+"""Micro-benchmark of the permission filter on a synthetic getcases result.
+
+Compares the original per-row lambda and four .str.contains passes with case_filter.filter_cases.
+
+Run from the repository root:
+    python -m benchmarks.bench_case_filter [row_count]
+"""
+
+import random
+import re
+import sys
+import timeit
+
+import pandas as pd
+
+from robot_framework.case_filter import filter_cases
+
+REFERENCE_NUMBERS = ["", None, "fak", " FAK ", "Faktura sendt 01-02", "faktureres ikke", "Annulleret", "ok", "Afventer svar", "12345", "sag æøå"]
+INITIALS = ["JADT", "ABCD", "EFGH", None]
+
+
+def make_permissions(row_count: int, seed: int = 42) -> pd.DataFrame:
+    """Create a synthetic getcases result with the columns used by the filter."""
+    rng = random.Random(seed)
+    return pd.DataFrame({
+        "case_id": range(row_count),
+        "authority_reference_number": [rng.choice(REFERENCE_NUMBERS) for _ in range(row_count)],
+        "initials": [rng.choice(INITIALS) for _ in range(row_count)],
+    })
+
+
+def legacy_filter(data_frame: pd.DataFrame) -> pd.DataFrame:
+    """The filter as it was implemented in process.process before case_filter existed."""
+    data_frame = data_frame.assign(cleaned_authority_reference_number=data_frame['authority_reference_number'].apply(
+        lambda x: re.sub(r'[^\x20-\x7E]', '', str(x).strip().lower()) if pd.notnull(x) else ''
+    ))
+    return data_frame[
+        ~(
+            data_frame['cleaned_authority_reference_number'].str.contains('faktura sendt') |
+            data_frame['cleaned_authority_reference_number'].str.contains('faktureres ikke') |
+            data_frame['cleaned_authority_reference_number'].str.contains('annulleret') |
+            (data_frame['cleaned_authority_reference_number'] == 'fak')
+        ) &
+        (data_frame['initials'] != 'JADT')
+    ]
+
+
+def main(row_count: int = 100_000, repeat: int = 5) -> None:
+    """Time both filters, check they keep the same permissions and print the speedup."""
+    data_frame = make_permissions(row_count)
+
+    legacy_ids = legacy_filter(data_frame)['case_id'].tolist()
+    vectorized_ids = filter_cases(data_frame)['case_id'].tolist()
+    if legacy_ids != vectorized_ids:
+        raise AssertionError("The vectorized filter keeps different permissions than the legacy filter.")
+
+    legacy_time = min(timeit.repeat(lambda: legacy_filter(data_frame), number=1, repeat=repeat))
+    vectorized_time = min(timeit.repeat(lambda: filter_cases(data_frame), number=1, repeat=repeat))
+
+    print(f"Rows:       {row_count} ({len(vectorized_ids)} kept)")
+    print(f"Legacy:     {legacy_time * 1000:.1f} ms")
+    print(f"Vectorized: {vectorized_time * 1000:.1f} ms")
+    print(f"Speedup:    {legacy_time / vectorized_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
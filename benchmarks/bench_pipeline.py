@@ -0,0 +1,227 @@
+"""End-to-end benchmark of process.process against the fake Vejman, an in-memory database and a counting SMTP server.
+
+Each size runs a cold sync into an empty VejmanFakturering, a warm rerun with the case cache and a recheck
+of every case without it, which must find every line unchanged in the ledger, and records cases/sec, HTTP calls, SQL statements, peak traced memory, rows written and mails sent.
+The results are compared with benchmarks/baseline.json and the run fails if one regressed beyond the threshold.
+
+Run from the repository root:
+    python -m benchmarks.bench_pipeline [--sizes 100,1000] [--repeat 2] [--threshold 0.25] [--update-baseline]
+        [--speed-baseline PATH]
+
+Cases/sec depends on the machine, so it is only compared with a --speed-baseline recorded on the same machine,
+e.g. by running the benchmark on the base branch first. The other metrics are compared with the stored baseline.
+"""
+
+import argparse
+import json
+import locale
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from contextlib import ExitStack
+from pathlib import Path
+from unittest import mock
+
+from benchmarks.fake_robot import FakeDatabase, FakeOrchestratorConnection, FakeSMTP
+from benchmarks.fake_vejman import FAKTURA_TEKSTER, FakeVejman, FakeVejmanSettings
+from robot_framework import pricebook
+
+BASELINE_PATH = Path(__file__).with_name("baseline.json")
+# A cold sync into an empty ledger filling the case cache, a rerun the next day that can skip unchanged cases,
+# and a rerun without the cache that compares every line with the rows read back from the database.
+SCENARIOS = {"cold": "--full-sync --case-cache rebuild", "warm": "--full-sync --case-cache use", "recheck": "--full-sync --case-cache bypass"}
+# Fake Vejman latencies, low enough that the robot's own work dominates the run time.
+LATENCY = {"getcases": 0.01, "getcase": 0.002, "pricebook": 0.002}
+
+# Peak memory may always grow by this much, since the peaks of the smallest runs are mostly fixed allocations.
+MEMORY_SLACK_MB = 0.5
+
+# Metrics that must not grow, and those that must stay the same for the run to be comparable.
+COUNT_METRICS = ("http_calls", "sql_statements")
+RESULT_METRICS = ("cases", "rows_written", "mails")
+
+
+def import_process():
+    """Import the process module. The benchmark never talks to SQL Server, so a missing ODBC driver only has to be importable."""
+    try:
+        import pyodbc  # noqa: F401  # pylint: disable=import-outside-toplevel,unused-import
+    except ImportError:
+        sys.modules["pyodbc"] = types.ModuleType("pyodbc")
+    from robot_framework import process  # pylint: disable=import-outside-toplevel
+    return process
+
+
+_setlocale = locale.setlocale
+
+
+def tolerant_setlocale(category, name=None):
+    """locale.setlocale falling back to the current locale when the Danish locale is not installed."""
+    try:
+        return _setlocale(category, name)
+    except locale.Error:
+        return _setlocale(category)
+
+
+def run_pipeline(process, size: int, trace_memory: bool) -> dict:
+    """Run the scenarios of one size.
+
+    Args:
+        process: The robot_framework.process module.
+        size: The permissions listed per equipment type.
+        trace_memory: Whether to record the peak memory with tracemalloc instead of timing the run.
+
+    Returns:
+        dict: The metrics of each scenario, keyed by scenario name.
+    """
+    results = {}
+    database = FakeDatabase(FAKTURA_TEKSTER)
+    settings = FakeVejmanSettings(case_count=size, latency=LATENCY)
+    summaries = []
+
+    def check_permissions(*args, **kwargs):
+        summary = check_permissions.wrapped(*args, **kwargs)
+        summaries.append(summary)
+        return summary
+    check_permissions.wrapped = process.CheckPermissions
+
+    with FakeVejman(settings) as fake, tempfile.TemporaryDirectory() as work_dir, ExitStack() as stack:
+        stack.enter_context(mock.patch.object(process.config, "VEJMAN_BASE_URL", fake.base_url))
+        stack.enter_context(mock.patch.object(process.config, "VEJMAN_RATE_LIMIT", 0))
+        stack.enter_context(mock.patch.object(process.pyodbc, "connect", database.connect, create=True))
+        stack.enter_context(mock.patch.object(process, "CheckPermissions", check_permissions))
+        stack.enter_context(mock.patch("smtplib.SMTP", FakeSMTP))
+        stack.enter_context(mock.patch("locale.setlocale", tolerant_setlocale))
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        stack.callback(os.chdir, cwd)
+
+        for scenario, process_arguments in SCENARIOS.items():
+            # Every run is a new robot process, which loads the pricebook from the snapshot file
+            stack.enter_context(mock.patch.dict(pricebook._memory, clear=True))  # pylint: disable=protected-access
+            orchestrator_connection = FakeOrchestratorConnection(settings.token, process_arguments)
+            http_calls = sum(count for key, count in fake.counts.items() if not key.endswith("_error"))
+            sql_statements = sum(count for kind, count in database.statements.items() if kind not in ("commit", "executemany_rows"))
+            rows_before = len(database.rows)
+            FakeSMTP.messages = 0
+
+            if trace_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            process.process(orchestrator_connection)
+            elapsed = time.perf_counter() - started
+            peak = 0
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            summary = summaries.pop()
+            results[scenario] = {
+                "seconds": elapsed,
+                "cases": summary["cases"],
+                "cases_per_second": summary["cases"] / elapsed,
+                "http_calls": sum(count for key, count in fake.counts.items() if not key.endswith("_error")) - http_calls,
+                "sql_statements": sum(count for kind, count in database.statements.items() if kind not in ("commit", "executemany_rows")) - sql_statements,
+                "rows_written": summary["written"],
+                "rows_added": len(database.rows) - rows_before,
+                "mails": FakeSMTP.messages,
+                "peak_memory_mb": peak / 2 ** 20,
+            }
+    return results
+
+
+def run(sizes: list[int], repeat: int) -> dict:
+    """Run every size, keeping the fastest of `repeat` timed passes and tracing the memory of one more."""
+    process = import_process()
+    results = {}
+    for size in sizes:
+        passes = [run_pipeline(process, size, trace_memory=False) for _ in range(repeat)]
+        traced = run_pipeline(process, size, trace_memory=True)
+        fastest = {scenario: min((timed[scenario] for timed in passes), key=lambda metrics: metrics["seconds"]) for scenario in SCENARIOS}
+        for scenario, metrics in fastest.items():
+            metrics["peak_memory_mb"] = traced[scenario]["peak_memory_mb"]
+        results[str(size)] = fastest
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float, speed_baseline: dict | None = None) -> list[str]:
+    """Compare the results with the baseline.
+
+    Args:
+        results: The results of this run, see run.
+        baseline: The stored baseline, compared on everything but cases/sec.
+        threshold: The allowed relative drop in cases/sec and growth in peak memory.
+        speed_baseline: A baseline recorded on this machine to compare cases/sec with, if any.
+
+    Returns:
+        list[str]: A description of each regression.
+    """
+    regressions = []
+    for size, scenarios in results.items():
+        for scenario, metrics in scenarios.items():
+            name = f"{size} cases {scenario}"
+
+            fastest = (speed_baseline or {}).get("results", {}).get(size, {}).get(scenario)
+            if fastest is not None and metrics["cases_per_second"] < fastest["cases_per_second"] * (1 - threshold):
+                regressions.append(f"{name}: cases/sec fell from {fastest['cases_per_second']:.1f} to {metrics['cases_per_second']:.1f}")
+
+            expected = baseline["results"].get(size, {}).get(scenario)
+            if expected is None:
+                continue
+            if metrics["peak_memory_mb"] > expected["peak_memory_mb"] * (1 + threshold) + MEMORY_SLACK_MB:
+                regressions.append(f"{name}: peak memory grew from {expected['peak_memory_mb']:.1f} MB to {metrics['peak_memory_mb']:.1f} MB")
+            for metric in COUNT_METRICS:
+                if metrics[metric] > expected[metric]:
+                    regressions.append(f"{name}: {metric} grew from {expected[metric]} to {metrics[metric]}")
+            for metric in RESULT_METRICS:
+                if metrics[metric] != expected[metric]:
+                    regressions.append(f"{name}: {metric} changed from {expected[metric]} to {metrics[metric]}")
+    return regressions
+
+
+def print_results(results: dict) -> None:
+    """Print a table of the results."""
+    print(f"{'Cases':>7} {'Run':<7} {'Seconds':>8} {'Cases/s':>8} {'HTTP':>6} {'SQL':>5} {'Rows':>6} {'Mails':>6} {'Peak MB':>8}")
+    for size, scenarios in results.items():
+        for scenario, metrics in scenarios.items():
+            print(f"{size:>7} {scenario:<7} {metrics['seconds']:>8.2f} {metrics['cases_per_second']:>8.1f} {metrics['http_calls']:>6} "
+                  f"{metrics['sql_statements']:>5} {metrics['rows_written']:>6} {metrics['mails']:>6} {metrics['peak_memory_mb']:>8.1f}")
+
+
+def main() -> int:
+    """Run the benchmark and compare it with, or store it as, the baseline."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="100,1000", help="Comma separated permissions per equipment type.")
+    parser.add_argument("--repeat", type=int, default=2, help="The timed passes per size, of which the fastest is kept.")
+    parser.add_argument("--threshold", type=float, default=0.25, help="The allowed relative drop in cases/sec and growth in peak memory.")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline instead of comparing.")
+    parser.add_argument("--speed-baseline", type=Path, help="A baseline recorded on this machine to compare cases/sec with.")
+    arguments = parser.parse_args()
+
+    results = run([int(size) for size in arguments.sizes.split(",")], arguments.repeat)
+    print_results(results)
+
+    if arguments.update_baseline:
+        baseline = {"python": platform.python_version(), "platform": platform.platform(), "results": results}
+        arguments.baseline.write_text(json.dumps(baseline, indent=2) + "\n", encoding="utf-8")
+        print(f"Baseline written to {arguments.baseline}")
+        return 0
+
+    baseline = json.loads(arguments.baseline.read_text(encoding="utf-8"))
+    speed_baseline = json.loads(arguments.speed_baseline.read_text(encoding="utf-8")) if arguments.speed_baseline else None
+    if speed_baseline is None:
+        print("Cases/sec is not compared without a --speed-baseline recorded on this machine")
+    regressions = compare(results, baseline, arguments.threshold, speed_baseline)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if not regressions:
+        print(f"No regressions beyond {arguments.threshold:.0%} of {arguments.baseline.name}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
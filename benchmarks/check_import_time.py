@@ -0,0 +1,83 @@
+"""Import-time audit of the framework modules with python -X importtime.
+
+Imports each module in a fresh interpreter, prints the slowest imports and fails if a module
+pulls in one of the HEAVY_MODULES, which the process should only load once there is work to do,
+or if its cumulative import time exceeds the budget.
+
+Run from the repository root:
+    python -m benchmarks.check_import_time [--budget-ms 2000] [--top 15] [module ...]
+"""
+
+import argparse
+import subprocess
+import sys
+
+# The modules that must be importable without loading the heavy dependencies.
+MODULES = ("robot_framework.queue_framework", "robot_framework.arguments", "robot_framework.config")
+# Dependencies only the process needs.
+HEAVY_MODULES = ("pandas", "numpy", "pyarrow", "requests", "urllib3", "pyodbc")
+
+
+def import_times(module: str) -> list[tuple[int, int, str]]:
+    """Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        list[tuple[int, int, str]]: The self and cumulative microseconds and the name of every module imported, in import order.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=False
+    )
+    if result.returncode != 0:
+        error = "\n".join(line for line in result.stderr.splitlines() if not line.startswith("import time:"))
+        raise RuntimeError(f"Importing {module} failed:\n{error}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        times.append((int(self_us), int(cumulative_us), name.strip()))
+    return times
+
+
+def audit(module: str, budget_ms: float, top: int) -> list[str]:
+    """Print the slowest imports of a module.
+
+    Returns:
+        list[str]: A description of each problem found.
+    """
+    times = import_times(module)
+    total_ms = sum(self_us for self_us, _, _ in times) / 1000
+    print(f"{module}: {total_ms:.0f} ms, {len(times)} modules")
+    for self_us, cumulative_us, name in sorted(times, key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {cumulative_us / 1000:>8.1f} ms cumulative {self_us / 1000:>7.1f} ms self  {name}")
+
+    problems = []
+    imported = {name for _, _, name in times}
+    heavy = [name for name in HEAVY_MODULES if name in imported]
+    if heavy:
+        problems.append(f"{module} imports {', '.join(heavy)}")
+    if total_ms > budget_ms:
+        problems.append(f"{module} took {total_ms:.0f} ms to import, above the budget of {budget_ms:.0f} ms")
+    return problems
+
+
+def main() -> int:
+    """Audit the modules and fail if one of them regressed."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    parser.add_argument("--budget-ms", type=float, default=2000, help="The most milliseconds a module may take to import.")
+    parser.add_argument("--top", type=int, default=15, help="The number of slowest imports to print per module.")
+    arguments = parser.parse_args()
+
+    problems = []
+    for module in arguments.modules:
+        problems.extend(audit(module, arguments.budget_ms, arguments.top))
+    for problem in problems:
+        print(f"Regression: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+"""In-memory stand-ins for SQL Server, SMTP and OpenOrchestrator, used to run process.process in benchmarks.
+
+FakeDatabase answers the statements the process sends with a pyodbc-like connection,
+keeping VejmanFakturering as a dict and counting every statement.
+"""
+
+import threading
+from collections import Counter
+from datetime import date, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+from robot_framework.ledger import COLUMNS, NUMERIC_COLUMNS
+
+# The columns stored as varchar, which the Vejman JSON holds as numbers.
+TEXT_COLUMNS = ("VejmanID", "VejmanFakturaID")
+
+
+class FakeDatabase:
+    """VejmanFakturaTekster and VejmanFakturering in memory behind a pyodbc-like connect()."""
+
+    def __init__(self, faktura_tekster: list[tuple[int, str]], start_date: date | None = None):
+        """
+        Args:
+            faktura_tekster: The (MaterielIDVejman, Fakturalinje) rows of VejmanFakturaTekster.
+            start_date: FraStartdato and FraSlutdato of every row, a year ago by default.
+        """
+        start_date = start_date or date.today() - timedelta(days=365)
+        self.groups: dict[int, list[str]] = {}
+        for materiel_id, fakturalinje in faktura_tekster:
+            self.groups.setdefault(materiel_id, []).append(fakturalinje)
+        self.start_date = start_date
+        self.rows: dict[str, SimpleNamespace] = {}
+        self.statements: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def connect(self, *_args, **_kwargs) -> "FakeConnection":
+        """Open a connection, like pyodbc.connect."""
+        return FakeConnection(self)
+
+    def count(self, kind: str, amount: int = 1) -> None:
+        """Count a statement."""
+        with self._lock:
+            self.statements[kind] += amount
+
+    def group_rows(self) -> list[tuple]:
+        """The result of the STRING_AGG query over VejmanFakturaTekster."""
+        return [
+            (materiel_id, ",".join(fakturalinjer), self.start_date, self.start_date)
+            for materiel_id, fakturalinjer in self.groups.items()
+        ]
+
+    def upsert(self, values: tuple) -> None:
+        """MERGE one row into VejmanFakturering.
+        Like SQL Server, the ids are stored as text and the prices as Decimal, so the process reads back other types than it wrote.
+        """
+        row = dict(zip(COLUMNS, values))
+        for column in TEXT_COLUMNS:
+            row[column] = str(row[column])
+        for column in NUMERIC_COLUMNS:
+            row[column] = Decimal(str(row[column])) if row[column] is not None else None
+        with self._lock:
+            existing = self.rows.get(str(row["VejmanFakturaID"]))
+            if existing is None:
+                self.rows[str(row["VejmanFakturaID"])] = SimpleNamespace(**row, Faktureret=0, SendTilFakturering=0, FakturerIkke=0)
+            else:
+                existing.__dict__.update({column: value for column, value in row.items() if column != "VejmanID"})
+
+
+class FakeConnection:
+    """A pyodbc-like connection to a FakeDatabase."""
+
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+        self._staging: list[tuple] = []
+        self._case_ids: set[str] = set()
+
+    def cursor(self) -> "FakeCursor":
+        """Open a cursor."""
+        return FakeCursor(self)
+
+    def commit(self) -> None:
+        """Count a commit."""
+        self.database.count("commit")
+
+    def rollback(self) -> None:
+        """Forget the staged rows."""
+        self._staging = []
+
+    def close(self) -> None:
+        """Nothing to close."""
+
+
+class FakeCursor:
+    """A pyodbc-like cursor answering the process's statements by their keywords."""
+
+    def __init__(self, connection: FakeConnection):
+        self.connection = connection
+        self.database = connection.database
+        self.fast_executemany = False
+        self._result: list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        """Nothing to close."""
+
+    def execute(self, query: str, *params):
+        """Run a statement against the in-memory tables."""
+        statement = " ".join(query.split()).upper()
+        if "VEJMANFAKTURATEKSTER" in statement:
+            self.database.count("select_tekster")
+            self._result = self.database.group_rows()
+        elif statement.startswith("MERGE") and "#VEJMANFAKTURERINGSTAGING" in statement:
+            self.database.count("merge_set")
+            for values in self.connection._staging:  # pylint: disable=protected-access
+                self.database.upsert(values)
+            self.connection._staging = []  # pylint: disable=protected-access
+        elif statement.startswith("MERGE"):
+            self.database.count("merge_row")
+            self.database.upsert(tuple(params[0] if len(params) == 1 and isinstance(params[0], (tuple, list)) else params)[-len(COLUMNS):])
+        elif "#VEJMANFAKTURERINGSTAGING" in statement:
+            self.database.count("staging")
+            self.connection._staging = []  # pylint: disable=protected-access
+        elif statement.startswith("SELECT") and "#VEJMANFAKTURERINGCASEIDS" in statement:
+            self.database.count("select_ledger")
+            case_ids = self.connection._case_ids  # pylint: disable=protected-access
+            self._result = [row for row in self.database.rows.values() if str(row.VejmanID) in case_ids]
+        elif "#VEJMANFAKTURERINGCASEIDS" in statement:
+            self.database.count("case_ids")
+            self.connection._case_ids = set()  # pylint: disable=protected-access
+        elif statement.startswith("SELECT") and "VEJMANFAKTURERING" in statement:
+            self.database.count("select_ledger")
+            self._result = list(self.database.rows.values())
+        else:
+            raise NotImplementedError(f"FakeDatabase does not know the statement: {query.strip()[:80]}")
+        return self
+
+    def executemany(self, query: str, rows: list[tuple]) -> None:
+        """Load rows into the staging table or the case id table."""
+        self.database.count("executemany")
+        self.database.count("executemany_rows", len(rows))
+        if "#VejmanFaktureringStaging" in query:
+            self.connection._staging.extend(rows)  # pylint: disable=protected-access
+        elif "#VejmanFaktureringCaseIds" in query:
+            self.connection._case_ids.update(str(row[0]) for row in rows)  # pylint: disable=protected-access
+        else:
+            raise NotImplementedError(f"FakeDatabase does not know the statement: {query.strip()[:80]}")
+
+    def fetchall(self) -> list:
+        """Get the whole result."""
+        result, self._result = self._result, []
+        return result
+
+    def fetchmany(self, size: int) -> list:
+        """Get the next part of the result."""
+        result, self._result = self._result[:size], self._result[size:]
+        return result
+
+    def fetchone(self):
+        """Get the next row of the result."""
+        return self.fetchmany(1)[0] if self._result else None
+
+
+class FakeSMTP:
+    """Counts the connections and mails of smtplib.SMTP instead of sending them."""
+    connections = 0
+    messages = 0
+    _lock = threading.Lock()
+
+    def __init__(self, *_args, **_kwargs):
+        with self._lock:
+            FakeSMTP.connections += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def starttls(self) -> None:
+        """Nothing to negotiate."""
+
+    def send_message(self, _message) -> None:
+        """Count a mail."""
+        with self._lock:
+            FakeSMTP.messages += 1
+
+
+class FakeOrchestratorConnection:
+    """The parts of OrchestratorConnection the process uses, with constants and credentials in memory."""
+
+    def __init__(self, token: str, process_arguments: str = "", constants: dict | None = None):
+        self.process_name = "Benchmark"
+        self.process_arguments = process_arguments
+        self.token = token
+        self.constants = {"JADT": "udvikler@example.dk", "SqlServer": "benchmark", "Error Email": "udvikler@example.dk", **(constants or {})}
+        self.logs: list[str] = []
+
+    def log_trace(self, message: str) -> None:
+        """Keep a trace message."""
+        self.logs.append(message)
+
+    def log_info(self, message: str) -> None:
+        """Keep an info message."""
+        self.logs.append(message)
+
+    def log_error(self, message: str) -> None:
+        """Keep an error message."""
+        self.logs.append(message)
+
+    def get_credential(self, _name: str) -> SimpleNamespace:
+        """Get the Vejman token."""
+        return SimpleNamespace(username="benchmark", password=self.token)
+
+    def get_constant(self, name: str) -> SimpleNamespace:
+        """Get a constant. Raises ValueError if it does not exist, like OpenOrchestrator."""
+        if name not in self.constants:
+            raise ValueError(f"No constant with name '{name}' was found.")
+        return SimpleNamespace(name=name, value=self.constants[name])
+
+    def update_constant(self, name: str, value: str) -> None:
+        """Update a constant."""
+        self.constants[name] = value
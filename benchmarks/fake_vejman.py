@@ -0,0 +1,288 @@
+"""A local stand-in for the Vejman API serving synthetic getcases, getcase and pricebook responses,
+with configurable latency, jitter, error injection and case counts.
+
+Run from the repository root:
+    python -m benchmarks.fake_vejman [--cases 10000] [--port 8765] [--latency 0.05] [--error-rate 0.01]
+
+and point the robot at it by setting config.VEJMAN_BASE_URL to the printed URL.
+The Fakturalinjer the cases are invoiced with are in FAKTURA_TEKSTER, for seeding [dbo].[VejmanFakturaTekster].
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# The pricebook and the Fakturalinjer of each MaterielIDVejman group, as (MaterielIDVejman, Fakturalinje) pairs.
+PRICEBOOK = [
+    {"text": "Stillads pr. m pr. dag", "unit_price": 8.0},
+    {"text": "Skurvogn pr. stk pr. dag", "unit_price": 25.0},
+    {"text": "Container pr. stk pr. dag", "unit_price": 30.0},
+    {"text": "Materialeoplag pr. m2 pr. dag", "unit_price": 4.5},
+    {"text": "Lift pr. stk pr. dag", "unit_price": 40.0},
+]
+FAKTURA_TEKSTER = [
+    (1, "Stillads"),
+    (2, "Skurvogn"),
+    (2, "Container"),
+    (5, "Materialeoplag"),
+    (9, "Lift"),
+]
+EQUIPMENT_TEXTS = {1: [0], 9: [0, 4], 2: [1, 2], 7: [1, 2], 5: [3]}
+
+REFERENCE_NUMBERS = ["", None, "ok", "12345", "fak", "faktura sendt", "Annulleret"]
+
+
+@dataclass
+class FakeVejmanSettings:
+    """How the fake Vejman behaves.
+
+    Attributes:
+        case_count: The number of permissions listed per equipment type.
+        latency: The mean seconds before each endpoint responds, keyed by getcases, getcase and pricebook.
+        jitter: The latency varies uniformly by up to this many seconds either way.
+        error_rate: The share of requests answered with 503 Service Unavailable.
+        mismatch_rate: The share of invoice details with a wrong price, so discrepancy mails are sent.
+        token: The token requests must carry.
+        seed: Seeds the synthetic data, so runs with the same settings serve the same cases.
+    """
+    case_count: int = 1000
+    latency: dict = field(default_factory=lambda: {"getcases": 0.2, "getcase": 0.02, "pricebook": 0.02})
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    mismatch_rate: float = 0.1
+    token: str = "fake-token"
+    seed: int = 42
+
+
+class FakeVejman:  # pylint: disable=too-many-instance-attributes
+    """A ThreadingHTTPServer serving the fake Vejman API on localhost, started in a background thread.
+
+    Use it as a context manager, or call start() and stop():
+        with FakeVejman(FakeVejmanSettings(case_count=10_000)) as fake:
+            config.VEJMAN_BASE_URL = fake.base_url
+    """
+
+    def __init__(self, settings: FakeVejmanSettings | None = None, port: int = 0):
+        self.settings = settings or FakeVejmanSettings()
+        self.counts: Counter = Counter()
+        self.today = date.today()
+        self._lock = threading.Lock()
+        self._cases_bodies: dict[tuple, bytes] = {}
+        self._pricebook_body = json.dumps({"data": PRICEBOOK}).encode("utf-8")
+        self._pricebook_etag = '"' + hashlib.sha1(self._pricebook_body).hexdigest() + '"'
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """The URL to use as VEJMAN_BASE_URL."""
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self) -> str:
+        """Start serving in a background thread and return the base URL."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        """Stop the server."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def case_ids(self, equipment_type: int) -> range:
+        """Get the ids of the permissions listed under an equipment type."""
+        return range(equipment_type * 10_000_000, equipment_type * 10_000_000 + self.settings.case_count)
+
+    def make_case(self, case_id: int) -> dict:
+        """Create the getcases row of a permission."""
+        rng = random.Random(case_id * 7919 + self.settings.seed)
+        start_date = self.today - timedelta(days=rng.randint(10, 120))
+        end_date = start_date + timedelta(days=rng.randint(1, 60))
+        completion_date = end_date - timedelta(days=rng.choice([0, 0, 0, 2, 5]))
+        return {
+            "case_id": case_id,
+            "case_number": f"T{case_id}",
+            "state": 8,
+            "type": "rovm",
+            "authority_reference_number": rng.choices(REFERENCE_NUMBERS, weights=[30, 20, 20, 10, 10, 5, 5])[0],
+            "start_date": start_date.strftime("%d-%m-%Y"),
+            "end_date": end_date.strftime("%d-%m-%Y"),
+            "completion_date": completion_date.strftime("%d-%m-%Y"),
+            "auto_completed": rng.choice([None, None, "AF"]),
+            "street_name": f"Testvej {rng.randint(1, 200)}",
+            "applicant": f"Entreprenør {case_id % 500}",
+            "cvr_number": None,
+            "initials": rng.choice(["ABCD", "EFGH", "IJKL", "JADT"]),
+        }
+
+    def make_case_detail(self, case_id: int) -> dict:
+        """Create the getcase details of a permission, with invoice lines for its equipment type's Fakturalinjer."""
+        case = self.make_case(case_id)
+        rng = random.Random(case_id * 104729 + self.settings.seed)
+        equipment_type = case_id // 10_000_000
+        start_date = date(*reversed([int(part) for part in case["start_date"].split("-")]))
+        end_date = date(*reversed([int(part) for part in case["end_date"].split("-")]))
+        days = (end_date - start_date).days + 1
+        length = rng.choice([5, 10, 12.5, 20])
+
+        details = []
+        for index in range(rng.randint(1, 3)):
+            entry = PRICEBOOK[rng.choice(EQUIPMENT_TEXTS.get(equipment_type, [0]))]
+            price = round(days * entry["unit_price"] * length, 2)
+            if rng.random() < self.settings.mismatch_rate:
+                price += rng.choice([-100.0, 50.0])
+            details.append({
+                "id": case_id * 10 + index,
+                "text": entry["text"],
+                "unit_price": f"{entry['unit_price'] * length:.2f}".replace(".", ","),
+                "price": price,
+                "units": days,
+            })
+
+        return {"data": {
+            "authEmail": f"sagsbehandler{case_id % 25}@example.dk",
+            "connected_case": f"{length} m".replace(".", ","),
+            "invoice": {"role": {"id": 1}, "details": details},
+            "contacts": [{
+                "roles": [{"role": {"id": 1}}],
+                "given_name": "Test",
+                "surname": f"Person {case_id % 100}",
+                "company_name": case["applicant"],
+                "cvr_number": rng.choices(["12345678", "1234567", ""], weights=[90, 5, 5])[0],
+            }],
+        }}
+
+    def cases_body(self, equipment_type: int, start_date_from: str, end_date_from: str) -> bytes:
+        """Get the getcases response of an equipment type, cached per window."""
+        key = (equipment_type, start_date_from, end_date_from)
+        with self._lock:
+            body = self._cases_bodies.get(key)
+        if body is None:
+            start_from = date.fromisoformat(start_date_from[:10]) if start_date_from else date.min
+            end_from = date.fromisoformat(end_date_from[:10]) if end_date_from else date.min
+            cases = []
+            for case_id in self.case_ids(equipment_type):
+                case = self.make_case(case_id)
+                start_date = date(*reversed([int(part) for part in case["start_date"].split("-")]))
+                end_date = date(*reversed([int(part) for part in case["end_date"].split("-")]))
+                if start_date >= start_from and end_date >= end_from:
+                    cases.append(case)
+            body = json.dumps({"cases": cases}).encode("utf-8")
+            with self._lock:
+                self._cases_bodies[key] = body
+        return body
+
+    def count(self, key: str) -> None:
+        """Count a request or an injected error."""
+        with self._lock:
+            self.counts[key] += 1
+
+
+def _handler(fake: FakeVejman) -> type:
+    """Create the request handler class of a FakeVejman."""
+
+    class Handler(BaseHTTPRequestHandler):
+        """Serves the fake Vejman endpoints."""
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """Answer a GET request after the configured latency."""
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+            endpoint = {"/permissions/getcases": "getcases", "/permissions/getcase": "getcase", "/services/data.do": "pricebook"}.get(url.path)
+            if endpoint is None:
+                self._send(404, b'{"error": "not found"}')
+                return
+            fake.count(endpoint)
+
+            settings = fake.settings
+            time.sleep(max(0.0, settings.latency.get(endpoint, 0.0) + random.uniform(-settings.jitter, settings.jitter)))
+            if query.get("token") != settings.token:
+                self._send(401, b'{"error": "invalid token"}')
+                return
+            if random.random() < settings.error_rate:
+                fake.count(f"{endpoint}_error")
+                self._send(503, b'{"error": "injected"}')
+                return
+
+            if endpoint == "getcases":
+                self._send(200, fake.cases_body(int(query["equipmentType"]), query.get("startDateFrom", ""), query.get("endDateFrom", "")))
+            elif endpoint == "getcase":
+                self._send(200, json.dumps(fake.make_case_detail(int(query["caseid"]))).encode("utf-8"))
+            elif self.headers.get("If-None-Match") == fake._pricebook_etag:  # pylint: disable=protected-access
+                self._send(304, b"")
+            else:
+                self._send(200, fake._pricebook_body, {"ETag": fake._pricebook_etag})  # pylint: disable=protected-access
+
+        def _send(self, status: int, body: bytes, headers: dict | None = None):
+            """Send a JSON response, gzipped if the client accepts it."""
+            if body and "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body, compresslevel=1)
+                headers = {**(headers or {}), "Content-Encoding": "gzip"}
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            """Do not log every request."""
+
+    return Handler
+
+
+def main() -> None:
+    """Serve the fake Vejman until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cases", type=int, default=1000, help="Permissions per equipment type, e.g. 1000, 10000 or 100000.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Mean getcase and pricebook latency in seconds.")
+    parser.add_argument("--list-latency", type=float, default=0.2, help="Mean getcases latency in seconds.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform latency jitter in seconds.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503.")
+    parser.add_argument("--mismatch-rate", type=float, default=0.1, help="Share of invoice details with a wrong price.")
+    parser.add_argument("--token", default="fake-token")
+    arguments = parser.parse_args()
+
+    settings = FakeVejmanSettings(
+        case_count=arguments.cases,
+        latency={"getcases": arguments.list_latency, "getcase": arguments.latency, "pricebook": arguments.latency},
+        jitter=arguments.jitter,
+        error_rate=arguments.error_rate,
+        mismatch_rate=arguments.mismatch_rate,
+        token=arguments.token,
+    )
+    fake = FakeVejman(settings, port=arguments.port)
+    print(f"Fake Vejman serving {settings.case_count} cases per equipment type at {fake.base_url} (token {settings.token})")
+    try:
+        fake.start()
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.stop()
+        print(dict(fake.counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,97 @@
 """The main file of the robot which will install all requirements in
 a virtual environment and then start the actual process.
+
+The virtual environment is reused between runs and only rebuilt when pyproject.toml,
+the lockfile or the Python version change. If a wheels folder exists next to this file,
+packages are installed from it without using the network.
 """
 
-import subprocess
+import hashlib
+import importlib.util
 import os
+import shutil
+import subprocess
 import sys
+import time
+
+# Pinned requirements, e.g. from: uv pip compile pyproject.toml -o requirements.lock
+LOCKFILE = "requirements.lock"
+# A folder of wheels for offline installs, e.g. from: pip download -r requirements.lock uv -d wheels
+WHEELHOUSE = "wheels"
+VENV_DIRECTORY = ".venv"
+# Holds the hash the environment was built from, written once the build has succeeded.
+HASH_FILE = os.path.join(VENV_DIRECTORY, "robot_environment.sha256")
+
+
+def environment_hash() -> str:
+    """Hash everything the environment is built from."""
+    digest = hashlib.sha256(sys.version.encode("utf-8"))
+    for path in ("pyproject.toml", LOCKFILE):
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                digest.update(path.encode("utf-8") + b"\0" + file.read())
+    return digest.hexdigest()
+
+
+def venv_python() -> str:
+    """Get the path of the Python interpreter of the virtual environment."""
+    if os.name == "nt":
+        return os.path.join(VENV_DIRECTORY, "Scripts", "python.exe")
+    return os.path.join(VENV_DIRECTORY, "bin", "python")
+
+
+def is_current(expected_hash: str) -> bool:
+    """Whether the virtual environment exists and was built from the same files."""
+    if not os.path.exists(venv_python()) or not os.path.exists(HASH_FILE):
+        return False
+    with open(HASH_FILE, encoding="utf-8") as file:
+        return file.read().strip() == expected_hash
+
+
+def build_environment(expected_hash: str) -> None:
+    """Create the virtual environment with uv and install the robot and its requirements."""
+    offline_args = ["--no-index", "--find-links", WHEELHOUSE] if os.path.isdir(WHEELHOUSE) else []
+
+    if importlib.util.find_spec("uv") is None:
+        subprocess.run([sys.executable, "-m", "pip", "install", *offline_args, "uv"], check=True)
+
+    # Start from scratch, so nothing is left over from the previous requirements,
+    # with the interpreter whose version is part of the environment hash
+    shutil.rmtree(VENV_DIRECTORY, ignore_errors=True)
+    subprocess.run([sys.executable, "-m", "uv", "venv", "--python", sys.executable, VENV_DIRECTORY], check=True)
+    install = [sys.executable, "-m", "uv", "pip", "install", "--python", venv_python(), *offline_args]
+    if os.path.exists(LOCKFILE):
+        subprocess.run([*install, "-r", LOCKFILE], check=True)
+        subprocess.run([*install, "--no-deps", "."], check=True)
+    else:
+        subprocess.run([*install, "."], check=True)
 
-script_directory = os.path.dirname(os.path.realpath(__file__))
-os.chdir(script_directory)
+    with open(HASH_FILE, "w", encoding="utf-8") as file:
+        file.write(expected_hash)
 
-# Install uv
-subprocess.run([sys.executable, "-m", "pip", "install", "uv"], check=True)
 
-# Create virtual environment
-subprocess.run(["uv", "venv"], check=True)
+def main() -> None:
+    """Provision the virtual environment if needed and run the robot in it."""
+    script_directory = os.path.dirname(os.path.realpath(__file__))
+    os.chdir(script_directory)
 
-# Install packages in the virtual environment
-subprocess.run(["uv", "pip", "install", "."], check=True)
+    started = time.perf_counter()
+    expected_hash = environment_hash()
+    if is_current(expected_hash):
+        provisioning = "reused"
+    else:
+        build_environment(expected_hash)
+        provisioning = "rebuilt"
+    provisioned = time.perf_counter()
+    print(f"Provisioning: {provisioned - started:.1f} s ({provisioning} {VENV_DIRECTORY})", flush=True)
 
+    # The robot is imported from this folder, so code changes do not need a rebuild
+    command_args = [venv_python(), "-m", "robot_framework"] + sys.argv[1:]
+    try:
+        subprocess.run(command_args, check=True)
+    finally:
+        print(f"Robot: {time.perf_counter() - provisioned:.1f} s", flush=True)
 
-command_args = [r".venv\Scripts\python", "-m", "robot_framework"] + sys.argv[1:]
 
-subprocess.run(command_args, check=True)
+if __name__ == "__main__":
+    main()
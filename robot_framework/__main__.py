@@ -1,7 +1,13 @@
 """The entry point of the process."""
 
-from robot_framework import linear_framework
-linear_framework.main()
+import sys
 
-# from robot_framework import queue_framework
-# queue_framework.main()
+from robot_framework.arguments import parse_argument_string
+
+# The process arguments are the fourth argument passed by OpenOrchestrator
+if parse_argument_string(sys.argv[4] if len(sys.argv) > 4 else None).worker:
+    from robot_framework import queue_framework
+    queue_framework.main()
+else:
+    from robot_framework import linear_framework
+    linear_framework.main()
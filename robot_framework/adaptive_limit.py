@@ -0,0 +1,118 @@
+"""This module contains an AIMD concurrency limit with a circuit breaker for the requests to Vejman."""
+
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+
+from robot_framework import config
+
+
+class AdaptiveLimit:  # pylint: disable=too-many-instance-attributes
+    """Limits the number of requests in flight and adjusts the limit from their outcomes.
+
+    The limit grows by one for every `limit` requests that succeed within their latency target (additive increase)
+    and is halved when a request fails or is too slow (multiplicative decrease), at most once per cooldown.
+    When the error rate of the last requests reaches the trip rate the circuit breaker opens and no requests
+    are sent until the break is over. A single probe request then decides whether to close it again.
+    """
+
+    def __init__(self, log: Callable[[str], None] | None = None,
+                 initial: int = config.VEJMAN_INITIAL_CONCURRENCY,
+                 minimum: int = config.VEJMAN_MIN_CONCURRENCY,
+                 maximum: int = config.GETCASE_WORKERS):
+        """
+        Args:
+            log: Called with a message when the limit is lowered or the circuit breaker opens or closes.
+            initial: The limit to start at.
+            minimum: The lowest limit.
+            maximum: The highest limit.
+        """
+        self.log = log or (lambda message: None)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.peak = int(self.limit)
+        self.throttle_count = 0
+        self.trip_count = 0
+
+        self._in_flight = 0
+        self._outcomes: deque[bool] = deque(maxlen=config.VEJMAN_BREAKER_WINDOW)
+        self._last_decrease = 0.0
+        self._open_until = 0.0
+        self._probing = False
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """Wait until a request may be sent, i.e. the circuit is closed and fewer than `limit` requests are in flight."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if now < self._open_until:
+                    self._condition.wait(self._open_until - now)
+                    continue
+                if self._open_until and not self._probing:
+                    # Half open: send a single probe request
+                    if self._in_flight == 0:
+                        self._probing = True
+                        self._in_flight += 1
+                        return
+                elif not self._open_until and self._in_flight < int(self.limit):
+                    self._in_flight += 1
+                    return
+                self._condition.wait()
+
+    def release(self, success: bool, latency: float, latency_target: float | None = None) -> None:
+        """Record the outcome of a request and adjust the limit.
+
+        Args:
+            success: Whether the request got a response that should not be retried.
+            latency: The seconds the request took.
+            latency_target: The latency above which the request counts as slow, or None for no target.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            now = time.monotonic()
+            slow = latency_target is not None and latency > latency_target
+
+            if self._probing:
+                self._probing = False
+                if success:
+                    self._open_until = 0.0
+                    self._outcomes.clear()
+                    self.limit = float(self.minimum)
+                    self.log(f"Vejman circuit breaker closed, concurrency restarts at {self.minimum}")
+                else:
+                    self._trip(now)
+                self._condition.notify_all()
+                return
+
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (len(self._outcomes) == self._outcomes.maxlen
+                    and failures / len(self._outcomes) >= config.VEJMAN_BREAKER_ERROR_RATE):
+                self._trip(now)
+            elif not success or slow:
+                if now - self._last_decrease >= config.VEJMAN_DECREASE_COOLDOWN:
+                    self._last_decrease = now
+                    previous = int(self.limit)
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                    self.throttle_count += 1
+                    reason = "an error" if not success else f"a {latency:.1f} s response"
+                    self.log(f"Vejman concurrency lowered from {previous} to {int(self.limit)} after {reason}")
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+                self.peak = max(self.peak, int(self.limit))
+            self._condition.notify_all()
+
+    def _trip(self, now: float) -> None:
+        """Open the circuit breaker for VEJMAN_BREAKER_SECONDS."""
+        self._open_until = now + config.VEJMAN_BREAKER_SECONDS
+        self._outcomes.clear()
+        self.trip_count += 1
+        self.log(f"Vejman circuit breaker opened for {config.VEJMAN_BREAKER_SECONDS} s after repeated errors")
+
+    def summary(self) -> str:
+        """Describe the concurrency of the run for the log."""
+        return (f"Vejman concurrency ended at {int(self.limit)} (peak {self.peak}), "
+                f"lowered {self.throttle_count} times, circuit breaker opened {self.trip_count} times")
@@ -0,0 +1,65 @@
+"""This module parses the process arguments passed to the robot from OpenOrchestrator."""
+
+import argparse
+import shlex
+
+from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
+
+from robot_framework import config
+
+
+def parse_process_arguments(orchestrator_connection: OrchestratorConnection) -> argparse.Namespace:
+    """Parse the process arguments string of the trigger as command line flags.
+    Unknown arguments are ignored so the trigger can carry other values as well.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+
+    Returns:
+        argparse.Namespace: The parsed flags.
+    """
+    return parse_argument_string(orchestrator_connection.process_arguments, orchestrator_connection.process_name)
+
+
+def parse_argument_string(process_arguments: str | None, prog: str | None = None) -> argparse.Namespace:
+    """Parse a process arguments string as command line flags, see parse_process_arguments.
+
+    Args:
+        process_arguments: The process arguments of the trigger.
+        prog: The program name used in error messages.
+
+    Returns:
+        argparse.Namespace: The parsed flags.
+    """
+    parser = argparse.ArgumentParser(prog=prog, add_help=False)
+    parser.add_argument(
+        "--case-cache", choices=("use", "bypass", "rebuild"), default=config.CASE_CACHE_MODE,
+        help="Use the on-disk getcase cache, bypass it entirely or clear it and rebuild it from this run."
+    )
+    parser.add_argument(
+        "--full-sync", action="store_true",
+        help="Run a full reconciliation sweep instead of an incremental sync from the last watermark."
+    )
+    parser.add_argument(
+        "--processes", type=int, default=config.SHARD_PROCESSES,
+        help="Check the equipment type families in this many parallel processes."
+    )
+    parser.add_argument(
+        "--dispatch", action="store_true",
+        help="Publish the sync as work items to the QUEUE_NAME queue instead of checking the cases in this run."
+    )
+    parser.add_argument(
+        "--profile", action="store_true", default=config.PROFILE,
+        help="Profile the run with cProfile and write the stats to PROFILE_DIR."
+    )
+    parser.add_argument(
+        "--profile-memory", action="store_true", default=config.PROFILE_MEMORY,
+        help="Trace the peak memory of the run and each stage with tracemalloc."
+    )
+    parser.add_argument(
+        "--worker", action="store_true",
+        help="Run the queue framework and check the work items in the QUEUE_NAME queue."
+    )
+
+    arguments, _ = parser.parse_known_args(shlex.split(process_arguments or ""))
+    return arguments
@@ -0,0 +1,129 @@
+"""This module contains a persistent on-disk cache of getcase payloads used to skip unchanged cases."""
+
+import hashlib
+import json
+import sqlite3
+from datetime import datetime
+
+from robot_framework import config
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    scope TEXT NOT NULL,
+    case_id TEXT NOT NULL,
+    payload_hash TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    faktura_ids TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (scope, case_id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class CaseCache:
+    """A SQLite cache keyed by scope and case_id holding the last successfully processed getcase payload and its hash.
+    Runs checking different equipment types, e.g. the shards of a sharded run, use their own scope,
+    since a case listed under several of them is hashed with different targets in each.
+
+    Entries seen during a run are staged in memory and only written by commit(),
+    which should be called once the run has finished successfully.
+
+    Modes:
+        use: Skip cases whose payload is unchanged since the last successful run.
+        bypass: Never skip a case and never touch the cache file.
+        rebuild: Clear the cache, process every case and store the result.
+    """
+
+    def __init__(self, path: str = config.CASE_CACHE_PATH, mode: str = "use", context: str = "", scope: str = ""):
+        """
+        Args:
+            path: The path of the SQLite file.
+            mode: One of 'use', 'bypass' or 'rebuild'.
+            context: A fingerprint of everything besides the payload that affects processing,
+                e.g. the Fakturalinjer and pricebook. The cache is cleared if it differs from the stored one.
+            scope: The part of the cache the run reads and writes, e.g. the equipment types it checks.
+        """
+        self.mode = mode
+        self.scope = scope
+        self.skipped_count = 0
+        self._staged: dict[str, tuple] = {}
+        self._connection = None
+
+        if mode == "bypass":
+            return
+
+        self._connection = sqlite3.connect(path)
+        columns = [column[1] for column in self._connection.execute("PRAGMA table_info(cases)")]
+        if columns and "scope" not in columns:
+            # Written before the cache had scopes
+            self._connection.execute("DROP TABLE cases")
+        self._connection.executescript(_SCHEMA)
+        stored_context = self._connection.execute("SELECT value FROM meta WHERE key = 'context'").fetchone()
+        if mode == "rebuild" or stored_context is None or stored_context[0] != context:
+            self._connection.execute("DELETE FROM cases")
+        self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('context', ?)", (context,))
+        self._connection.commit()
+
+    def is_unchanged(self, case_id, payload_hash: str, ledger) -> bool:
+        """Whether a case can be skipped because its payload is the same as in the last successful run
+        and every invoice line written for it then is still present in the ledger.
+
+        Args:
+            case_id: The Vejman case id.
+            payload_hash: The hash of the case as computed by hash_payload.
+            ledger: The FakturaLedger of the run.
+        """
+        if self.mode != "use":
+            return False
+
+        cached = self._connection.execute(
+            "SELECT payload_hash, faktura_ids FROM cases WHERE scope = ? AND case_id = ?", (self.scope, str(case_id))
+        ).fetchone()
+        if cached is None or cached[0] != payload_hash:
+            return False
+        if not all(faktura_id in ledger for faktura_id in json.loads(cached[1])):
+            return False
+
+        self.skipped_count += 1
+        return True
+
+    def stage(self, case_id, payload_hash: str, payload, faktura_ids: list) -> None:
+        """Remember a processed case so it can be written to the cache when the run succeeds.
+
+        Args:
+            case_id: The Vejman case id.
+            payload_hash: The hash of the case as computed by hash_payload.
+            payload: The getcase payload to store.
+            faktura_ids: The VejmanFakturaIDs the case has rows for after processing.
+        """
+        if self.mode == "bypass":
+            return
+        self._staged[str(case_id)] = (payload_hash, json.dumps(payload, default=str), json.dumps(faktura_ids, default=str))
+
+    def commit(self) -> None:
+        """Write all staged cases to the cache file."""
+        if self._connection is None:
+            return
+        now = datetime.now().isoformat(timespec="seconds")
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO cases (scope, case_id, payload_hash, payload, faktura_ids, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(self.scope, case_id, *values, now) for case_id, values in self._staged.items()]
+        )
+        self._connection.commit()
+        self._staged = {}
+
+    def close(self) -> None:
+        """Close the cache file without writing staged cases."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def hash_payload(*parts) -> str:
+    """Hash JSON serializable parts, e.g. a getcase payload and its getcases row, independently of key order."""
+    serialized = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
@@ -0,0 +1,72 @@
+"""This module contains the vectorized filter that decides which Vejman permissions should be checked."""
+
+import re
+
+import pandas as pd
+
+from robot_framework import config
+
+# Removes everything but printable ASCII from a reference number.
+_NON_PRINTABLE = r'[^\x20-\x7E]'
+
+
+def build_exclusion_pattern(phrases: tuple[str, ...], exact_values: tuple[str, ...]) -> str:
+    """Build one regex matching a cleaned reference number that contains any of the phrases
+    or is exactly one of the exact values.
+
+    Args:
+        phrases: Phrases that exclude a permission wherever they occur in the reference number.
+        exact_values: Values that exclude a permission when they are the whole reference number.
+
+    Returns:
+        str: The regex pattern.
+    """
+    alternatives = [re.escape(phrase) for phrase in phrases]
+    if exact_values:
+        alternatives.append("^(?:" + "|".join(re.escape(value) for value in exact_values) + ")$")
+    return "|".join(alternatives)
+
+
+def clean_reference_numbers(reference_numbers: pd.Series) -> pd.Series:
+    """Strip, lowercase and remove non printable characters from authority reference numbers.
+    Missing values become empty strings.
+
+    Args:
+        reference_numbers: The authority_reference_number column of a getcases result.
+
+    Returns:
+        pd.Series: The cleaned reference numbers as an Arrow backed string column.
+    """
+    return (
+        reference_numbers.astype("string[pyarrow]")
+        .str.strip()
+        .str.lower()
+        .str.replace(_NON_PRINTABLE, "", regex=True)
+        .fillna("")
+    )
+
+
+def filter_cases(data_frame: pd.DataFrame,
+                 phrases: tuple[str, ...] = config.EXCLUDED_REFERENCE_PHRASES,
+                 exact_values: tuple[str, ...] = config.EXCLUDED_REFERENCE_VALUES,
+                 excluded_initials: tuple[str, ...] = config.EXCLUDED_INITIALS) -> pd.DataFrame:
+    """Remove permissions that are already invoiced, should not be invoiced, are cancelled
+    or belong to an excluded caseworker.
+
+    Args:
+        data_frame: The permissions as returned by getcases.
+        phrases: Reference number phrases that exclude a permission.
+        exact_values: Whole reference numbers that exclude a permission.
+        excluded_initials: Caseworker initials whose permissions are excluded.
+
+    Returns:
+        pd.DataFrame: The permissions to check, with a cleaned_authority_reference_number column added.
+    """
+    cleaned = clean_reference_numbers(data_frame['authority_reference_number'])
+    pattern = build_exclusion_pattern(phrases, exact_values)
+    excluded = cleaned.str.contains(pattern, regex=True) if pattern else pd.Series(False, index=cleaned.index)
+    if 'initials' in data_frame.columns:
+        excluded |= data_frame['initials'].isin(excluded_initials)
+
+    data_frame = data_frame.assign(cleaned_authority_reference_number=cleaned)
+    return data_frame[~excluded.to_numpy(dtype=bool)]
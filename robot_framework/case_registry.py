@@ -0,0 +1,56 @@
+"""This module contains a run-wide registry of the Vejman cases to check."""
+
+import pandas as pd
+
+# The getcases fields ParseCase reads. Only these are kept, so a registered case costs a small dict rather than a row of the list.
+CASE_FIELDS = ("case_id", "case_number", "start_date", "end_date", "completion_date", "auto_completed", "applicant", "street_name")
+
+
+class CaseRegistry:
+    """Collects the filtered permissions of every equipment type and Fakturalinje group in a run.
+    A case listed under several equipment types is kept once, together with every
+    (equipment_type, fakturalinjer) target it should be matched against, so its getcase
+    details only have to be fetched and parsed once.
+    """
+
+    def __init__(self):
+        self._rows: dict = {}
+        self._targets: dict[object, list[tuple]] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def register(self, data_frame: pd.DataFrame, equipment_type, fakturalinjer: str) -> list:
+        """Register the permissions of a filtered getcases result for a Fakturalinje group.
+
+        Args:
+            data_frame: The filtered permissions as returned by getcases.
+            equipment_type: The Vejman equipment type the permissions were listed under.
+            fakturalinjer: The comma separated Fakturalinjer of the group.
+
+        Returns:
+            list: The ids of the cases that were not registered before.
+        """
+        new_case_ids = []
+        fields = [field for field in CASE_FIELDS if field in data_frame.columns]
+        for row in data_frame[fields].to_dict("records"):
+            case_id = row['case_id']
+            if case_id not in self._rows:
+                self._rows[case_id] = row
+                new_case_ids.append(case_id)
+            targets = self._targets.setdefault(case_id, [])
+            if (equipment_type, fakturalinjer) not in targets:
+                targets.append((equipment_type, fakturalinjer))
+        return new_case_ids
+
+    def case_ids(self) -> list:
+        """Get the ids of all registered cases."""
+        return list(self._rows)
+
+    def row(self, case_id) -> dict:
+        """Get the CASE_FIELDS of a case from its getcases row."""
+        return self._rows[case_id]
+
+    def targets(self, case_id) -> list[tuple]:
+        """Get the (equipment_type, fakturalinjer) pairs a case should be matched against, in registration order."""
+        return self._targets[case_id]
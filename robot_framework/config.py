@@ -11,14 +11,106 @@ SMTP_SERVER = "smtp.adm.aarhuskommune.dk"
 SMTP_PORT = 25
 SCREENSHOT_SENDER = "vejmanfaktura@aarhus.dk"
 
+# Discrepancy mail config
+# Whether discrepancy mails are collected into one digest per caseworker, or sent as one mail per permit.
+# Either way they are sent at the end of the run over a single SMTP connection.
+EMAIL_DIGEST = True
+
+# Vejman fetch config
+VEJMAN_BASE_URL = "https://vejman.vd.dk"
+# (connect, read) timeouts in seconds per Vejman endpoint. getcases returns the whole permission list.
+VEJMAN_TIMEOUTS = {"getcases": (10, 500), "getcase": (10, 60), "pricebook": (10, 60)}
+# Timeouts, connection errors and 429/5xx responses are retried this many times,
+# waiting a random time up to VEJMAN_BACKOFF_BASE * 2^attempt seconds, at most VEJMAN_BACKOFF_MAX.
+VEJMAN_RETRIES = 4
+VEJMAN_BACKOFF_BASE = 1.0
+VEJMAN_BACKOFF_MAX = 30.0
+# The sustained Vejman requests per second, and how many can be sent at once after a pause.
+VEJMAN_RATE_LIMIT = 20.0
+VEJMAN_RATE_BURST = 10
+# The requests in flight start at VEJMAN_INITIAL_CONCURRENCY and grow by one per round of fast, successful
+# requests up to GETCASE_WORKERS. They are halved, at most once per VEJMAN_DECREASE_COOLDOWN seconds, on an
+# error or a response slower than the endpoint's latency target in seconds.
+VEJMAN_INITIAL_CONCURRENCY = 4
+VEJMAN_MIN_CONCURRENCY = 1
+VEJMAN_LATENCY_TARGETS = {"getcase": 5.0}
+VEJMAN_DECREASE_COOLDOWN = 2.0
+# Requests are paused for VEJMAN_BREAKER_SECONDS when at least VEJMAN_BREAKER_ERROR_RATE
+# of the last VEJMAN_BREAKER_WINDOW requests failed.
+VEJMAN_BREAKER_WINDOW = 20
+VEJMAN_BREAKER_ERROR_RATE = 0.5
+VEJMAN_BREAKER_SECONDS = 30
+# The most getcase requests kept in flight at the same time.
+GETCASE_WORKERS = 16
+# Whether the getcases permission list is parsed while it downloads, so getcase requests start before it is complete.
+STREAM_PERMISSIONS = True
+# The number of permissions filtered and registered together while streaming, and the download chunk size in bytes.
+PERMISSION_BATCH_SIZE = 500
+PERMISSION_STREAM_CHUNK_SIZE = 65536
+# The number of processes the equipment type families are checked in. With 1 everything runs in the robot's own process.
+SHARD_PROCESSES = 1
+# The case counts of the last sharded run, used to start the longest shards first.
+SHARD_HISTORY_PATH = "shard_history.json"
+# The number of case/Fakturalinje groups whose invoice lines are price validated together.
+VALIDATION_BATCH_SIZE = 200
+
+# Permission filter config
+# Authority reference number phrases that exclude a permission, matched case insensitively anywhere in the text.
+EXCLUDED_REFERENCE_PHRASES = ("faktura sendt", "faktureres ikke", "annulleret")
+# Authority reference numbers that exclude a permission when they are the whole text.
+EXCLUDED_REFERENCE_VALUES = ("fak",)
+# Caseworker initials whose permissions are never checked.
+EXCLUDED_INITIALS = ("JADT",)
+
+# Pricebook config
+# The local snapshot of the Vejman pricebook and how long it is used before it is refreshed.
+PRICEBOOK_CACHE_PATH = "pricebook_cache.json"
+PRICEBOOK_TTL_HOURS = 24
+
+# Database config
+# The number of invoice lines staged before they are merged into VejmanFakturering.
+MERGE_BATCH_SIZE = 500
+# The number of VejmanFakturering rows fetched at a time when the ledger of the checked cases is loaded.
+LEDGER_FETCH_SIZE = 5000
+
+# Case cache config
+# The SQLite file holding the getcase payloads of the last successful run.
+CASE_CACHE_PATH = "case_cache.sqlite3"
+# The default cache mode, 'use', 'bypass' or 'rebuild'. Can be overridden with --case-cache in the process arguments.
+CASE_CACHE_MODE = "use"
+
+# Sync config
+# Whether to only fetch cases that were still running at the last successful sync.
+INCREMENTAL_SYNC = True
+# How many days before the last sync a case may have ended and still be fetched incrementally.
+INCREMENTAL_LOOKBACK_DAYS = 14
+# How often a full reconciliation sweep of the whole window is run.
+FULL_SYNC_INTERVAL_DAYS = 7
+
+# Metrics config
+# The run metrics are always logged to OpenOrchestrator. They are also written to this path if it is set,
+# as a Prometheus textfile if it ends in .prom, e.g. for the node exporter's textfile collector, otherwise as JSON.
+METRICS_EXPORT_PATH = None
+
+# Profiling config
+# Whether runs are profiled with cProfile, written to PROFILE_DIR with a report of the PROFILE_TOP_FUNCTIONS
+# slowest functions, and whether the peak memory of each stage is traced. Can be enabled per trigger
+# with --profile and --profile-memory in the process arguments.
+PROFILE = False
+PROFILE_MEMORY = False
+PROFILE_DIR = "profiles"
+PROFILE_TOP_FUNCTIONS = 40
+
 # Constant/Credential names
 ERROR_EMAIL = "Error Email"
+FULL_SYNC_CONSTANT = "VejmanKassenFuldSynkroniseret"
 
 # Queue specific configs
 # ----------------------
 
 # The name of the job queue (if any)
-QUEUE_NAME = None
+# A --dispatch run publishes a work item per equipment type family here, and --worker runs check them.
+QUEUE_NAME = "VejmanFakturering"
 
 # The limit on how many queue elements to process
 MAX_TASK_COUNT = 100
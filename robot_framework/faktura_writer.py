@@ -0,0 +1,136 @@
+"""This module contains a batch writer that upserts invoice lines into VejmanFakturering."""
+
+from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
+
+from robot_framework import config, metrics
+from robot_framework.ledger import COLUMNS, FakturaLedger
+
+# The columns updated when a row already exists.
+UPDATE_COLUMNS = tuple(column for column in COLUMNS if column not in ("VejmanID", "VejmanFakturaID"))
+_FAKTURA_ID_INDEX = COLUMNS.index("VejmanFakturaID")
+
+STAGING_TABLE = "#VejmanFaktureringStaging"
+
+_CREATE_STAGING_QUERY = f"""
+IF OBJECT_ID('tempdb..{STAGING_TABLE}') IS NOT NULL DROP TABLE {STAGING_TABLE};
+SELECT TOP 0 {", ".join(COLUMNS)} INTO {STAGING_TABLE} FROM [dbo].[VejmanFakturering];
+"""
+
+_INSERT_STAGING_QUERY = f"INSERT INTO {STAGING_TABLE} ({', '.join(COLUMNS)}) VALUES ({', '.join('?' for _ in COLUMNS)})"
+
+_SET_MERGE_QUERY = f"""
+MERGE INTO [dbo].[VejmanFakturering] AS target
+USING {STAGING_TABLE} AS source
+ON target.VejmanFakturaID = source.VejmanFakturaID
+WHEN MATCHED THEN
+    UPDATE SET {", ".join(f"{column} = source.{column}" for column in UPDATE_COLUMNS)}
+WHEN NOT MATCHED THEN
+    INSERT ({", ".join(COLUMNS)})
+    VALUES ({", ".join(f"source.{column}" for column in COLUMNS)});
+"""
+
+_ROW_MERGE_QUERY = f"""
+MERGE INTO [dbo].[VejmanFakturering] AS target
+USING (SELECT ? AS VejmanFakturaID) AS source
+ON target.VejmanFakturaID = source.VejmanFakturaID
+WHEN MATCHED THEN
+    UPDATE SET {", ".join(f"{column} = ?" for column in UPDATE_COLUMNS)}
+WHEN NOT MATCHED THEN
+    INSERT ({", ".join(COLUMNS)})
+    VALUES ({", ".join("?" for _ in COLUMNS)});
+"""
+
+
+class FakturaWriter:
+    """Collects computed invoice lines and upserts them into VejmanFakturering in batches.
+    Lines identical to the row already in the ledger are skipped, and every queued line is
+    recorded in the ledger so later lines in the run see the fresh state.
+    Each batch is bulk loaded into a staging temp table with fast_executemany and applied
+    with a single set-based MERGE in one transaction. If that fails the batch is rolled back
+    and written row by row instead. The VejmanFakturaIDs of committed lines are kept in stored_ids.
+
+    Call flush once every line is added so the last partial batch is written.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, conn, ledger: FakturaLedger, orchestrator_connection: OrchestratorConnection, batch_size: int = config.MERGE_BATCH_SIZE):
+        """
+        Args:
+            conn: An open pyodbc connection to the PyOrchestrator database.
+            ledger: The in-memory index of VejmanFakturering for this run.
+            orchestrator_connection: The connection to OpenOrchestrator used for logging.
+            batch_size: The number of lines to collect before a batch is written.
+        """
+        self.conn = conn
+        self.ledger = ledger
+        self.orchestrator_connection = orchestrator_connection
+        self.batch_size = batch_size
+        self.written_count = 0
+        self.unchanged_count = 0
+        self.stored_ids: set[str] = set()
+        self._pending: dict[str, dict] = {}
+        self._staging_created = False
+
+    def add(self, row: dict) -> None:
+        """Queue a line for upserting unless its row already holds the same values.
+        A later line with the same VejmanFakturaID replaces an earlier one.
+
+        Args:
+            row: The values of the line keyed by the names in COLUMNS.
+        """
+        if self.ledger.is_unchanged(row):
+            self.unchanged_count += 1
+            return
+
+        self.ledger.upsert(row)
+        self._pending[str(row["VejmanFakturaID"])] = row
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all queued lines to the database."""
+        if not self._pending:
+            return
+
+        rows = [tuple(row[column] for column in COLUMNS) for row in self._pending.values()]
+        self._pending = {}
+
+        try:
+            self._write_set_based(rows)
+            self.stored_ids.update(str(row[_FAKTURA_ID_INDEX]) for row in rows)
+        # Any driver error should make us fall back to the slow but proven path.
+        # pylint: disable-next = broad-exception-caught
+        except Exception as error:
+            self.conn.rollback()
+            self._staging_created = False
+            self.orchestrator_connection.log_info(f"Bulk upsert of {len(rows)} rows failed, falling back to row by row: {error!r}")
+            self._write_row_by_row(rows)
+
+        self.written_count += len(rows)
+        metrics.count("rows_written", len(rows))
+
+    def _write_set_based(self, rows: list[tuple]) -> None:
+        """Bulk load the rows into the staging table and merge them in one transaction."""
+        with metrics.timer("sql_merge"):
+            with self.conn.cursor() as cursor:
+                if self._staging_created:
+                    cursor.execute(f"TRUNCATE TABLE {STAGING_TABLE}")
+                else:
+                    cursor.execute(_CREATE_STAGING_QUERY)
+                    self._staging_created = True
+
+                cursor.fast_executemany = True
+                cursor.executemany(_INSERT_STAGING_QUERY, rows)
+                cursor.execute(_SET_MERGE_QUERY)
+            self.conn.commit()
+
+    def _write_row_by_row(self, rows: list[tuple]) -> None:
+        """Merge the rows one at a time, committing after each row."""
+        update_indices = [COLUMNS.index(column) for column in UPDATE_COLUMNS]
+        for row in rows:
+            params = (row[_FAKTURA_ID_INDEX], *(row[i] for i in update_indices), *row)
+            with metrics.timer("sql_merge_row"):
+                with self.conn.cursor() as cursor:
+                    cursor.execute(_ROW_MERGE_QUERY, params)
+                self.conn.commit()
+            self.stored_ids.add(str(row[_FAKTURA_ID_INDEX]))
@@ -0,0 +1,70 @@
+"""This module contains a compiled matcher for the Fakturalinjer of a VejmanFakturaTekster group."""
+
+import bisect
+import functools
+import re
+
+# Joins the detail texts of a case so they can be scanned in one pass.
+# Fakturalinjer never contain it, so a match cannot span two texts.
+_SEPARATOR = "\x00"
+
+
+class FakturalinjeMatcher:  # pylint: disable=too-few-public-methods
+    """Finds the first Fakturalinje contained in an invoice detail text.
+    A Fakturalinje matches when its stripped, lowercased text is a substring of the stripped, lowercased
+    detail text, and the Fakturalinje listed first wins when several match.
+    """
+
+    def __init__(self, fakturalinjer: list[str]):
+        """
+        Args:
+            fakturalinjer: The candidate Fakturalinjer in priority order.
+        """
+        self.fakturalinjer = list(fakturalinjer)
+
+        self._index: dict[str, int] = {}
+        for index, fakturalinje in enumerate(self.fakturalinjer):
+            self._index.setdefault(fakturalinje.strip().lower(), index)
+
+        # An empty Fakturalinje is contained in every text
+        self._empty_index = self._index.pop("", None)
+
+        # The lookahead finds a match at every position, and since the alternation is in priority
+        # order it captures the highest priority Fakturalinje starting there.
+        patterns = sorted(self._index, key=self._index.get)
+        self._regex = re.compile("(?=(" + "|".join(re.escape(pattern) for pattern in patterns) + "))") if patterns else None
+
+    def match_all(self, texts: list[str | None]) -> list[str | None]:
+        """Match all detail texts of a case in one pass.
+
+        Args:
+            texts: The invoice detail texts.
+
+        Returns:
+            list: The first matching Fakturalinje of each text, or None where there is no match.
+        """
+        lowered = [(text or "").strip().lower() for text in texts]
+        best = [self._empty_index] * len(lowered)
+
+        if self._regex is not None and lowered:
+            starts = []
+            offset = 0
+            for text in lowered:
+                starts.append(offset)
+                offset += len(text) + len(_SEPARATOR)
+
+            for match in self._regex.finditer(_SEPARATOR.join(lowered)):
+                text_index = bisect.bisect_right(starts, match.start()) - 1
+                index = self._index[match.group(1)]
+                if best[text_index] is None or index < best[text_index]:
+                    best[text_index] = index
+
+        return [self.fakturalinjer[index] if index is not None else None for index in best]
+
+
+@functools.lru_cache(maxsize=None)
+def get_matcher(fakturalinjer: str) -> FakturalinjeMatcher:
+    """Get the compiled matcher for the comma separated Fakturalinjer of a VejmanFakturaTekster group.
+    Matchers are cached on the aggregated text, so a matcher is only rebuilt when the table changes.
+    """
+    return FakturalinjeMatcher(fakturalinjer.split(','))
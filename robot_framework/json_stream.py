@@ -0,0 +1,102 @@
+"""This module contains an incremental parser for JSON arrays in a chunked HTTP response body."""
+
+import codecs
+import json
+from collections.abc import Iterable, Iterator
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+# Characters that can follow a complete value, so a number cut off by the end of a chunk is not accepted early.
+_DELIMITERS = _WHITESPACE + ",:]}"
+
+
+class _Buffer:
+    """Text decoded from a stream of byte chunks, read from the front as values are parsed."""
+
+    def __init__(self, chunks: Iterable[bytes], encoding: str):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self.text = ""
+        self.position = 0
+        self.exhausted = False
+
+    def fill(self) -> bool:
+        """Read the next chunk into the buffer. Returns False when the stream has ended."""
+        if self.exhausted:
+            return False
+        self.text = self.text[self.position:]
+        self.position = 0
+        try:
+            self.text += self._decoder.decode(next(self._chunks))
+        except StopIteration:
+            self.text += self._decoder.decode(b"", final=True)
+            self.exhausted = True
+        return True
+
+    def peek(self) -> str:
+        """Get the next non whitespace character without consuming it, or "" at the end of the stream."""
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in _WHITESPACE:
+                self.position += 1
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.fill():
+                return ""
+
+    def expect(self, characters: str) -> str:
+        """Consume the next non whitespace character, which must be one of the given characters."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Expected one of {characters!r} at position {self.position} of the JSON stream, got {character!r}")
+        self.position += 1
+        return character
+
+    def value(self):
+        """Parse the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.text, self.position)
+                if self.exhausted or (end < len(self.text) and self.text[end] in _DELIMITERS):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            self.fill()
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str, encoding: str = "utf-8") -> Iterator:
+    """Yield the items of the array under a key of a top level JSON object while the body is still downloading.
+    Only one item of the array is held in memory at a time, other keys are parsed and discarded.
+
+    Args:
+        chunks: The response body, e.g. from response.iter_content.
+        key: The key of the array in the top level object.
+        encoding: The text encoding of the body.
+
+    Yields:
+        The items of the array in order. Nothing is yielded if the key is missing or null.
+    """
+    buffer = _Buffer(chunks, encoding)
+    buffer.expect("{")
+    if buffer.peek() == "}":
+        return
+
+    while True:
+        name = buffer.value()
+        buffer.expect(":")
+        if name == key and buffer.peek() == "[":
+            buffer.expect("[")
+            if buffer.peek() != "]":
+                while True:
+                    yield buffer.value()
+                    if buffer.expect(",]") == "]":
+                        break
+            else:
+                buffer.expect("]")
+        else:
+            buffer.value()
+
+        if buffer.expect(",}") == "}":
+            return
@@ -0,0 +1,177 @@
+"""This module contains an in-memory index of the VejmanFakturering table."""
+
+import hashlib
+from dataclasses import dataclass
+
+from robot_framework import config
+
+# The columns written to VejmanFakturering by the process, in insert order.
+COLUMNS = (
+    "VejmanID", "Ansøger", "FørsteSted", "Tilladelsesnr", "CvrNr", "TilladelsesType",
+    "Enhedspris", "Meter", "Startdato", "Slutdato", "VejmanFakturaID", "ATT"
+)
+
+# The final-state flags set outside the process.
+FLAG_COLUMNS = ("Faktureret", "SendTilFakturering", "FakturerIkke")
+
+# The columns compared by value, since SQL returns them as Decimal while the process computes floats.
+NUMERIC_COLUMNS = ("Enhedspris", "Meter")
+
+CASE_IDS_TABLE = "#VejmanFaktureringCaseIds"
+
+# The temp table gets the type of VejmanID from the table itself, so the join needs no conversion.
+_CREATE_CASE_IDS_QUERY = f"""
+IF OBJECT_ID('tempdb..{CASE_IDS_TABLE}') IS NOT NULL DROP TABLE {CASE_IDS_TABLE};
+SELECT TOP 0 VejmanID INTO {CASE_IDS_TABLE} FROM [PyOrchestrator].[dbo].[VejmanFakturering];
+"""
+
+_INSERT_CASE_IDS_QUERY = f"INSERT INTO {CASE_IDS_TABLE} (VejmanID) VALUES (?)"
+
+_SELECT_LEDGER_QUERY = f"""
+SELECT {", ".join(f"f.{column}" for column in COLUMNS + FLAG_COLUMNS)}
+FROM [PyOrchestrator].[dbo].[VejmanFakturering] AS f
+JOIN (SELECT DISTINCT VejmanID FROM {CASE_IDS_TABLE}) AS c ON c.VejmanID = f.VejmanID
+"""
+
+
+@dataclass
+class LedgerRow:
+    """The columns of a VejmanFakturering row that the process reads between upserts.
+    Attribute names mirror the SQL columns so the row can be used like a pyodbc row.
+    """
+    # pylint: disable=invalid-name
+    VejmanFakturaID: int | str
+    Startdato: str | None = None
+    Slutdato: str | None = None
+    Faktureret: int | None = None
+    SendTilFakturering: int | None = None
+    FakturerIkke: int | None = None
+    content_hash: str | None = None
+
+    @property
+    def is_final(self) -> bool:
+        """Whether the row has been invoiced, sent to invoicing or marked as not to be invoiced."""
+        return self.Faktureret == 1 or self.SendTilFakturering == 1 or self.FakturerIkke == 1
+
+
+class FakturaLedger:
+    """A hash index over VejmanFakturering keyed by VejmanFakturaID.
+    The ledger is built once per run and updated in place whenever the run upserts a row,
+    so later invoice details in the same run see the fresh state without re-reading the table.
+    """
+
+    def __init__(self):
+        self._rows: dict[str, LedgerRow] = {}
+
+    @classmethod
+    def load(cls, conn, case_ids: list, fetch_size: int = config.LEDGER_FETCH_SIZE) -> "FakturaLedger":
+        """Load the rows of VejmanFakturering written for the given cases.
+        The case ids are bulk loaded into a temp table that the table is joined with, and only the
+        columns the ledger uses are read, fetch_size rows at a time, so the run does not hold the
+        whole history of the table in memory.
+
+        Args:
+            conn: An open pyodbc connection to the PyOrchestrator database.
+            case_ids: The ids of the Vejman cases checked in this run, matching the VejmanID column.
+            fetch_size: The number of rows fetched from the server at a time.
+
+        Returns:
+            FakturaLedger: The populated ledger.
+        """
+        ledger = cls()
+        if not case_ids:
+            return ledger
+
+        with conn.cursor() as cursor:
+            cursor.execute(_CREATE_CASE_IDS_QUERY)
+            cursor.fast_executemany = True
+            cursor.executemany(_INSERT_CASE_IDS_QUERY, [(case_id,) for case_id in case_ids])
+            cursor.execute(_SELECT_LEDGER_QUERY)
+            while rows := cursor.fetchmany(fetch_size):
+                ledger.add_cursor_rows(rows)
+        return ledger
+
+    def add_cursor_rows(self, rows) -> None:
+        """Add rows fetched from VejmanFakturering.
+
+        Args:
+            rows: Rows with attribute access to the VejmanFakturering columns, e.g. pyodbc rows.
+        """
+        for row in rows:
+            self._rows[_key(row.VejmanFakturaID)] = LedgerRow(
+                VejmanFakturaID=row.VejmanFakturaID,
+                Startdato=row.Startdato,
+                Slutdato=row.Slutdato,
+                Faktureret=row.Faktureret,
+                SendTilFakturering=row.SendTilFakturering,
+                FakturerIkke=row.FakturerIkke,
+                content_hash=content_hash({column: getattr(row, column) for column in COLUMNS}),
+            )
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, faktura_id) -> bool:
+        return _key(faktura_id) in self._rows
+
+    def get(self, faktura_id) -> LedgerRow | None:
+        """Get the row with the given VejmanFakturaID, if any."""
+        return self._rows.get(_key(faktura_id))
+
+    def is_unchanged(self, values: dict) -> bool:
+        """Whether writing the given line would leave its existing row unchanged.
+
+        Args:
+            values: The values of the line keyed by the names in COLUMNS.
+        """
+        row = self.get(values["VejmanFakturaID"])
+        return row is not None and row.content_hash == content_hash(values)
+
+    def upsert(self, values: dict) -> LedgerRow:
+        """Record that the run has merged a line into VejmanFakturering.
+        Final-state flags are left untouched since the process never writes them.
+
+        Args:
+            values: The values of the line keyed by the names in COLUMNS.
+
+        Returns:
+            LedgerRow: The updated or inserted row.
+        """
+        faktura_id = values["VejmanFakturaID"]
+        row = self.get(faktura_id)
+        if row is None:
+            row = LedgerRow(VejmanFakturaID=faktura_id)
+            self._rows[_key(faktura_id)] = row
+        row.Startdato = values["Startdato"]
+        row.Slutdato = values["Slutdato"]
+        row.content_hash = content_hash(values)
+        return row
+
+
+def content_hash(values: dict) -> str:
+    """Hash the written columns of a line so a computed line can be compared with a stored row.
+    The NUMERIC_COLUMNS are compared by value, so a Decimal read from SQL equals the float computed by the process.
+    Every other column is compared as text, so e.g. a varchar id read from SQL equals the int in the Vejman JSON.
+
+    Args:
+        values: The values of the line keyed by the names in COLUMNS.
+
+    Returns:
+        str: A hex digest of the normalized values.
+    """
+    normalized = "\x1f".join(_normalize(column, values.get(column)) for column in COLUMNS)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _normalize(column: str, value) -> str:
+    """Convert a column value to a canonical string."""
+    if value is None:
+        return ""
+    if column in NUMERIC_COLUMNS:
+        return repr(round(float(value), 6))
+    return str(value).strip()
+
+
+def _key(faktura_id) -> str:
+    """Normalize a VejmanFakturaID so ids read from SQL and from the Vejman JSON compare equal."""
+    return str(faktura_id).strip()
@@ -12,6 +12,8 @@ from robot_framework import reset
 from robot_framework.exceptions import BusinessError, handle_error, log_exception
 from robot_framework import process
 from robot_framework import config
+from robot_framework.arguments import parse_process_arguments
+from robot_framework.profiling import profile_run
 
 
 def main():
@@ -22,11 +24,13 @@ def main():
     orchestrator_connection.log_trace("Robot Framework started.")
     initialize.initialize(orchestrator_connection)
 
+    arguments = parse_process_arguments(orchestrator_connection)
     error_count = 0
     for _ in range(config.MAX_RETRY_COUNT):
         try:
             reset.reset(orchestrator_connection)
-            process.process(orchestrator_connection)
+            with profile_run(orchestrator_connection, "process", arguments.profile, arguments.profile_memory):
+                process.process(orchestrator_connection)
             break
 
         # If any business rules are broken the robot should stop entirely.
@@ -0,0 +1,251 @@
+"""This module contains the timers, counters and latency histograms collected during a run of the robot."""
+
+import json
+import math
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# The upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+# The prefix of the metric names in the Prometheus export.
+PROMETHEUS_PREFIX = "vejman_faktura"
+
+# The running peaks of the blocks being measured by track_memory_peak in each thread, innermost last.
+_peak_stack = threading.local()
+
+
+@contextmanager
+def track_memory_peak():
+    """Measure the peak traced memory of a block while tracemalloc is tracing.
+    Blocks can be nested: tracemalloc only has one peak, so the peak of an enclosing block is
+    kept here when an inner block resets it.
+
+    Yields:
+        list: A list whose only item is set to the peak in bytes when the block ends, or stays 0 when not tracing.
+    """
+    peak = [0]
+    if not tracemalloc.is_tracing():
+        yield peak
+        return
+
+    stack = _peak_stack.__dict__.setdefault("peaks", [])
+    if stack:
+        stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    stack.append(0)
+    try:
+        yield peak
+    finally:
+        peak[0] = max(stack.pop(), tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1] = max(stack[-1], peak[0])
+
+
+class Histogram:
+    """Counts observations into cumulative LATENCY_BUCKETS, like a Prometheus histogram."""
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """Record an observation."""
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Get the upper bound of the bucket holding the q quantile, capped at the largest observation."""
+        rank = q * self.count
+        for bound, cumulative in zip(LATENCY_BUCKETS, self.buckets):
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def merge(self, other: "Histogram") -> None:
+        """Add the observations of another histogram."""
+        self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+
+class RunMetrics:
+    """The metrics of one run. Timers sum the seconds spent in a stage or statement, counters count events
+    and histograms record the latency distribution of each Vejman endpoint. All methods are thread safe.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters: dict[str, float] = {}
+        self.timers: dict[str, list[float]] = {}
+        self.histograms: dict[str, Histogram] = {}
+        self.memory_peaks: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Shard processes send their metrics back pickled, without the lock
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: float = 1) -> None:
+        """Add to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Add a timing to a timer."""
+        with self._lock:
+            totals = self.timers.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def add_memory_peak(self, name: str, peak: int) -> None:
+        """Record the peak traced memory in bytes of a timer, keeping the highest of its calls."""
+        with self._lock:
+            self.memory_peaks[name] = max(self.memory_peaks.get(name, 0), peak)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Time the block and add it to a timer, also when it raises.
+        While tracemalloc is tracing, the peak memory of the block is recorded as well.
+        """
+        started = time.perf_counter()
+        peak = [0]
+        try:
+            with track_memory_peak() as peak:
+                yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+            if peak[0]:
+                self.add_memory_peak(name, peak[0])
+
+    def observe(self, name: str, value: float) -> None:
+        """Record an observation in a histogram."""
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).observe(value)
+
+    def merge(self, other: "RunMetrics") -> None:
+        """Add the metrics of another run, e.g. a shard process."""
+        with self._lock:
+            for name, amount in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for name, (calls, seconds) in other.timers.items():
+                totals = self.timers.setdefault(name, [0, 0.0])
+                totals[0] += calls
+                totals[1] += seconds
+            for name, histogram in other.histograms.items():
+                self.histograms.setdefault(name, Histogram()).merge(histogram)
+            for name, peak in other.memory_peaks.items():
+                self.memory_peaks[name] = max(self.memory_peaks.get(name, 0), peak)
+
+    def summary(self) -> dict:
+        """Get the run summary, with cases/sec over the whole run and the p50/p95 of each histogram.
+        The peak memory of each timer in MB is included when it was traced.
+        """
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            summary = {
+                "seconds": round(elapsed, 3),
+                "cases_per_second": round(self.counters.get("cases", 0) / elapsed, 2) if elapsed else 0.0,
+                "counters": dict(sorted(self.counters.items())),
+                "timers": {name: {"count": calls, "seconds": round(seconds, 3)} for name, (calls, seconds) in sorted(self.timers.items())},
+                "histograms": {
+                    name: {
+                        "count": histogram.count,
+                        "mean": round(histogram.sum / histogram.count, 4) if histogram.count else 0.0,
+                        "p50": histogram.quantile(0.5),
+                        "p95": histogram.quantile(0.95),
+                        "max": round(histogram.max, 4),
+                    }
+                    for name, histogram in sorted(self.histograms.items())
+                },
+            }
+            if self.memory_peaks:
+                summary["memory_peaks_mb"] = {name: round(peak / 2 ** 20, 1) for name, peak in sorted(self.memory_peaks.items())}
+            return summary
+
+    def to_prometheus(self) -> str:
+        """Format the metrics as a Prometheus textfile, for the node exporter's textfile collector."""
+        lines = []
+        summary = self.summary()
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_run_seconds gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}_run_seconds {summary['seconds']}")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_cases_per_second gauge")
+        lines.append(f"{PROMETHEUS_PREFIX}_cases_per_second {summary['cases_per_second']}")
+        with self._lock:
+            for name, amount in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_total {amount}")
+            for name, (calls, seconds) in sorted(self.timers.items()):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_seconds summary")
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_seconds_sum {seconds}")
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_seconds_count {calls}")
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_seconds histogram")
+                for bound, cumulative in zip(LATENCY_BUCKETS, histogram.buckets):
+                    le = "+Inf" if math.isinf(bound) else bound
+                    lines.append(f'{PROMETHEUS_PREFIX}_{name}_seconds_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_seconds_sum {histogram.sum}")
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_seconds_count {histogram.count}")
+            for name, peak in sorted(self.memory_peaks.items()):
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_peak_memory_bytes gauge")
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}_peak_memory_bytes {peak}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str) -> None:
+        """Write the metrics to a Prometheus textfile if the path ends in .prom, otherwise to a JSON file.
+        The file is replaced atomically, so a collector never reads a half written file.
+        """
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        os.replace(temporary_path, path)
+
+
+_current = RunMetrics()
+
+
+def reset() -> RunMetrics:
+    """Start collecting the metrics of a new run."""
+    global _current  # pylint: disable=global-statement
+    _current = RunMetrics()
+    return _current
+
+
+def current() -> RunMetrics:
+    """Get the metrics of the current run."""
+    return _current
+
+
+def count(name: str, amount: float = 1) -> None:
+    """Add to a counter of the current run."""
+    _current.count(name, amount)
+
+
+def timer(name: str):
+    """Time a block into a timer of the current run."""
+    return _current.timer(name)
+
+
+def observe(name: str, value: float) -> None:
+    """Record an observation in a histogram of the current run."""
+    _current.observe(name, value)
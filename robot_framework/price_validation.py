@@ -0,0 +1,83 @@
+"""This module contains the columnar price validation of matched invoice lines."""
+
+import numpy as np
+import pandas as pd
+
+from robot_framework.pricebook import Pricebook
+
+# Columns that must not be upcast by pandas, e.g. ints with missing values to floats.
+_RAW_COLUMNS = ('VejmanFakturaID', 'detail_unit_price', 'price', 'units')
+
+
+def validate_invoice_lines(lines: list[dict], pricebook: Pricebook) -> pd.DataFrame:
+    """Validate the prices of a batch of matched invoice lines in one vectorized pass.
+
+    Each line is a dict with the keys:
+        target: Index of the case/Fakturalinje group the line belongs to.
+        VejmanFakturaID, detail_text, detail_unit_price, price, units: From the invoice detail.
+        existing: Whether the line already has a row in VejmanFakturering.
+        ledger_start, ledger_end: The YYYY-MM-DD dates of the existing row, if any.
+        start_date, end_date, completion_date, auto_completed, connected_case: From the case.
+
+    The dates of a line without a row run from the start date to the completion date if it is
+    earlier than the end date and the case is not auto completed ('AF'). Lines with a row keep its dates.
+    A line whose VejmanFakturaID occurs earlier in the batch is treated as having the row written by the earlier one.
+
+    Args:
+        lines: The matched invoice lines.
+        pricebook: The pricebook to look up unit prices in.
+
+    Returns:
+        pd.DataFrame: The lines with the added columns start, chosen_end, mail_end, days_period, unit_price,
+            length, total_calculated_price, mismatch, calculated_length, length_mismatch, days_mismatch and
+            completion_used.
+    """
+    frame = pd.DataFrame(lines)
+    if frame.empty:
+        return frame
+    # Keep the detail values as Vejman sent them, so they are written and quoted in mails unchanged
+    for column in _RAW_COLUMNS:
+        frame[column] = pd.Series([line[column] for line in lines], index=frame.index, dtype=object)
+
+    existing = frame['existing'].astype(bool)
+    ledger_start = pd.to_datetime(frame['ledger_start'], format="%Y-%m-%d", errors='coerce')
+    ledger_end = pd.to_datetime(frame['ledger_end'], format="%Y-%m-%d", errors='coerce')
+    start_date = pd.to_datetime(frame['start_date'])
+    end_date = pd.to_datetime(frame['end_date'])
+    completion_date = pd.to_datetime(frame['completion_date'])
+
+    new_end = end_date.where((frame['auto_completed'] == "AF") | (end_date <= completion_date), completion_date)
+    frame['start'] = ledger_start.where(existing, start_date)
+    frame['chosen_end'] = ledger_end.where(existing, new_end)
+    frame['mail_end'] = ledger_end.where(existing, end_date)
+
+    # Later lines for the same VejmanFakturaID see the row written by the first one
+    faktura_key = frame['VejmanFakturaID'].astype(str)
+    duplicate = faktura_key.duplicated(keep='first')
+    if duplicate.any():
+        for column in ('start', 'chosen_end', 'mail_end'):
+            first = frame.groupby(faktura_key, sort=False)[column].transform('first')
+            frame[column] = first.where(duplicate, frame[column])
+        existing = existing | duplicate
+    frame['existing'] = existing
+
+    frame['days_period'] = (frame['chosen_end'].dt.normalize() - frame['start'].dt.normalize()).dt.days + 1
+
+    frame['unit_price'] = pd.to_numeric(pricebook.lookup_unit_prices(frame['detail_text']), errors='coerce').fillna(0.0).astype(float)
+    detail_unit_price = pd.to_numeric(
+        frame['detail_unit_price'].astype(str).str.replace(",", ".", regex=False), errors='coerce'
+    ).fillna(0.0)
+
+    length = frame['connected_case'].astype(str).str.replace(",", ".", regex=False).str.extract(r'(\d+(?:\.\d+)?)', expand=False)
+    frame['length'] = pd.to_numeric(length, errors='coerce').fillna(0.0)
+
+    frame['total_calculated_price'] = (frame['days_period'] * (frame['unit_price'] * frame['length'])).round(2)
+    price = pd.to_numeric(frame['price'], errors='coerce').fillna(0.0)
+    frame['mismatch'] = ~((frame['total_calculated_price'] != 0) & ((frame['total_calculated_price'] - price).abs() <= 0.01))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frame['calculated_length'] = np.where(frame['unit_price'] != 0, (detail_unit_price / frame['unit_price']).round(2), 0.0)
+    frame['length_mismatch'] = frame['length'] != frame['calculated_length']
+    frame['days_mismatch'] = ~(pd.to_numeric(frame['units'], errors='coerce') == frame['days_period'])
+    frame['completion_used'] = frame['chosen_end'] != frame['mail_end']
+    return frame
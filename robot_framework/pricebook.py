@@ -0,0 +1,119 @@
+"""This module contains the Vejman pricebook and a local, TTL based cache of it."""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+import requests
+
+from robot_framework import config
+from robot_framework.vejman_client import VejmanClient
+
+# The snapshot and pricebook of the current Python process, reused by later process runs.
+_memory: dict = {}
+
+
+def normalize_text(text) -> str:
+    """Normalize an invoice text for lookups: casefolded and with all whitespace collapsed to single spaces."""
+    return " ".join(str(text).split()).casefold()
+
+
+class Pricebook:
+    """The v_h_pm_pricebook table indexed by invoice text.
+    Lookups try the exact text first and fall back to the normalized text.
+    """
+
+    def __init__(self, items: list[dict]):
+        self.entries = {item['text']: item for item in items}
+        self._normalized: dict[str, dict] = {}
+        for item in items:
+            self._normalized.setdefault(normalize_text(item['text']), item)
+        self.fingerprint = hashlib.sha256(json.dumps(items, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, text, default=None) -> dict | None:
+        """Get the pricebook entry of an invoice text."""
+        entry = self.entries.get(text)
+        if entry is None:
+            entry = self._normalized.get(normalize_text(text))
+        return entry if entry is not None else default
+
+    def lookup_unit_prices(self, texts: pd.Series) -> pd.Series:
+        """Get the unit price of every invoice text in a column. Texts without an entry get NaN."""
+        unit_prices = texts.map({text: item.get('unit_price', 0) for text, item in self.entries.items()})
+        missing = unit_prices.isna()
+        if missing.any():
+            normalized_prices = {text: item.get('unit_price', 0) for text, item in self._normalized.items()}
+            unit_prices[missing] = texts[missing].map(normalize_text).map(normalized_prices)
+        return unit_prices
+
+
+def load_pricebook(client: VejmanClient, path: str = config.PRICEBOOK_CACHE_PATH,
+                   ttl: timedelta = timedelta(hours=config.PRICEBOOK_TTL_HOURS)) -> Pricebook:
+    """Get the pricebook, downloading it only when the local snapshot is older than the TTL.
+    A refresh is sent as a conditional request when the snapshot has an ETag or Last-Modified header,
+    and a stale snapshot is used if the refresh fails.
+
+    Args:
+        client: The Vejman client to download the pricebook with.
+        path: The path of the JSON snapshot.
+        ttl: How long a snapshot is used before it is refreshed.
+
+    Returns:
+        Pricebook: The pricebook.
+    """
+    snapshot = _memory.get('snapshot') or _read_snapshot(path)
+    now = datetime.now()
+
+    if snapshot is None or now - datetime.fromisoformat(snapshot['fetched_at']) >= ttl:
+        headers = {}
+        if snapshot and snapshot.get('etag'):
+            headers['If-None-Match'] = snapshot['etag']
+        if snapshot and snapshot.get('last_modified'):
+            headers['If-Modified-Since'] = snapshot['last_modified']
+
+        try:
+            response = client.get_pricebook(headers)
+            if response.status_code == 304 and snapshot is not None:
+                snapshot = dict(snapshot, fetched_at=now.isoformat())
+            else:
+                snapshot = {
+                    'fetched_at': now.isoformat(),
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'data': response.json().get('data', []),
+                }
+            _write_snapshot(path, snapshot)
+        except requests.RequestException:
+            if snapshot is None:
+                raise
+
+    if _memory.get('snapshot') is not snapshot:
+        _memory['snapshot'] = snapshot
+        _memory['pricebook'] = Pricebook(snapshot['data'])
+    return _memory['pricebook']
+
+
+def _read_snapshot(path: str) -> dict | None:
+    """Read the snapshot file if it exists and is valid."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as file:
+            snapshot = json.load(file)
+        datetime.fromisoformat(snapshot['fetched_at'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return snapshot if isinstance(snapshot.get('data'), list) else None
+
+
+def _write_snapshot(path: str, snapshot: dict) -> None:
+    """Atomically replace the snapshot file."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump(snapshot, file)
+    os.replace(temp_path, path)
@@ -1,131 +1,509 @@
 """This module contains the main process of the robot."""
 
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
-from OpenOrchestrator.database.queues import QueueElement
-from robot_framework import config
+from OpenOrchestrator.database.queues import QueueElement, QueueStatus
+from robot_framework import config, metrics
+from robot_framework.exceptions import BusinessError
+from robot_framework.ledger import FakturaLedger
+from robot_framework.faktura_writer import FakturaWriter
+from robot_framework.case_registry import CaseRegistry
+from robot_framework.case_cache import CaseCache, hash_payload
+from robot_framework.arguments import parse_process_arguments
+from robot_framework.fakturalinje_matcher import get_matcher
+from robot_framework.case_filter import filter_cases
+from robot_framework.price_validation import validate_invoice_lines
+from robot_framework.pricebook import Pricebook, load_pricebook
+from robot_framework.json_stream import iter_json_array
+from robot_framework.vejman_client import VejmanClient
 
-import requests
 import random
 import re
-import time
 import string
 import pyodbc
 
 import pandas as pd
+import itertools
+import json
 import locale
 import smtplib
 from email.message import EmailMessage
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import Counter, namedtuple
+
+# A VejmanFakturaTekster group, as a picklable tuple so it can be passed to shard processes
+FakturaTekstGroup = namedtuple("FakturaTekstGroup", ["MaterielIDVejman", "Fakturalinjer", "EarliestStartDate", "EarliestSlutDate"])
+# A work item published by DispatchWorkItems, see ParseWorkItem
+WorkItem = namedtuple("WorkItem", ["fetch_plan", "sync_started", "full_sync", "references"])
+
 
-# pylint: disable-next=unused-argument
 def process(orchestrator_connection: OrchestratorConnection, queue_element: QueueElement | None = None) -> None:
     """Do the primary process of the robot."""
     
     orchestrator_connection.log_trace("Running process.")
+    metrics.reset()
+    arguments = parse_process_arguments(orchestrator_connection)
     token = orchestrator_connection.get_credential("VejmanToken").password
-    pricebook_map = FetchPricebookData(token)
-    developer_email = orchestrator_connection.get_constant("JADT").value
+    # One pooled session for the pricebook and every getcases and getcase request of the run
+    with VejmanClient(token, log=orchestrator_connection.log_info) as client:
+        with metrics.timer("stage_pricebook"):
+            pricebook = FetchPricebookData(client)
+        developer_email = orchestrator_connection.get_constant("JADT").value
+
+        sql_server = orchestrator_connection.get_constant("SqlServer")
+        conn_string = "DRIVER={SQL Server};"+f"SERVER={sql_server.value};DATABASE=PYORCHESTRATOR;Trusted_Connection=yes;"
+        conn = pyodbc.connect(conn_string)
+        cursor = conn.cursor()
+
+        # Fetch all rows from the table
+        query = """SELECT 
+            MaterielIDVejman, 
+            STRING_AGG(Fakturalinje, ',') AS Fakturalinjer, 
+            MIN(FraStartdato) AS EarliestStartDate,
+            MIN(FraSlutdato) AS EarliestSlutDate
+        FROM [dbo].[VejmanFakturaTekster]
+        GROUP BY MaterielIDVejman
+        """
+        with metrics.timer("sql_select_tekster"):
+            cursor.execute(query)
+            rows = [FakturaTekstGroup(*row) for row in cursor.fetchall()]
+        outbox = Outbox(developer_email)
+
+        if queue_element is not None:
+            # Worker mode: check the equipment types of one work item published by a dispatcher run
+            work_item = ParseWorkItem(queue_element, rows)
+            try:
+                summary = CheckPermissions(work_item.fetch_plan, rows, client, pricebook, conn, arguments.case_cache, outbox, orchestrator_connection)
+            finally:
+                SendMails(outbox, orchestrator_connection)
+            LogRunSummary(summary, orchestrator_connection)
+            CompleteDispatchedSync(queue_element, work_item, orchestrator_connection)
+            LogRunMetrics(orchestrator_connection)
+            return
+
+        # Plan one getcases call per equipment type covering every group's window,
+        # narrowed to cases still running since the last sync unless a full sweep is due
+        sync_started = datetime.now()
+        watermark = GetSyncWatermark(arguments.full_sync, orchestrator_connection)
+        fetch_plan = PlanPermissionFetches(rows, watermark)
+
+        if arguments.dispatch:
+            # The sync is complete once the workers are done, see CompleteDispatchedSync
+            DispatchWorkItems(fetch_plan, rows, sync_started, watermark is None, orchestrator_connection)
+        else:
+            try:
+                if arguments.processes > 1:
+                    conn.close()
+                    summary = RunShards(fetch_plan, rows, token, pricebook, conn_string, arguments, outbox, orchestrator_connection)
+                else:
+                    summary = CheckPermissions(fetch_plan, rows, client, pricebook, conn, arguments.case_cache, outbox, orchestrator_connection)
+            finally:
+                SendMails(outbox, orchestrator_connection)
+            LogRunSummary(summary, orchestrator_connection)
+            # The sync is complete once every case is checked
+            AdvanceSyncConstants(sync_started, watermark is None, orchestrator_connection)
+        LogRunMetrics(orchestrator_connection)
 
-    sql_server = orchestrator_connection.get_constant("SqlServer")
-    conn_string = "DRIVER={SQL Server};"+f"SERVER={sql_server.value};DATABASE=PYORCHESTRATOR;Trusted_Connection=yes;"
-    conn = pyodbc.connect(conn_string)
-    cursor = conn.cursor()
-
-    # Make this as a single process dispatcher so multiple processes can run
-    # Fetch all rows from the table
-    query = """SELECT 
-        MaterielIDVejman, 
-        STRING_AGG(Fakturalinje, ',') AS Fakturalinjer, 
-        MIN(FraStartdato) AS EarliestStartDate,
-        MIN(FraSlutdato) AS EarliestSlutDate
-    FROM [dbo].[VejmanFakturaTekster]
-    GROUP BY MaterielIDVejman
+
+def CheckPermissions(fetch_plan, rows, client: VejmanClient, pricebook: Pricebook, conn, case_cache_mode, outbox, orchestrator_connection: OrchestratorConnection):
+    """Check the invoice lines of every permission in the planned getcases windows, upsert them and queue
+    mails to the caseworkers about discrepancies. Rerunning it for the same plan only writes and mails what changed.
+    If it fails, only the mails of lines that were stored before the error are left in the outbox.
+
+    Args:
+        fetch_plan: The (start date, end date) window to fetch, keyed by equipment type, see PlanPermissionFetches.
+        rows: The VejmanFakturaTekster groups.
+        client: The run's Vejman client, whose session the getcases and getcase requests share.
+        case_cache_mode: The mode of the case cache, see CaseCache.
+
+    Returns:
+        collections.Counter: The run summary with the number of cases checked, skipped, upserted and unchanged lines.
     """
-    cursor.execute(query)
-    rows = cursor.fetchall()
+    # A case is hashed with its targets among the planned equipment types only, so each plan caches it separately
+    case_cache = CaseCache(mode=case_cache_mode, context=CaseCacheContext(rows, pricebook), scope=ShardKey(fetch_plan))
 
-    query = """SELECT * FROM [PyOrchestrator].[dbo].[VejmanFakturering]"""
-    cursor.execute(query)
-    faktura_db = cursor.fetchall()
+    registry = CaseRegistry()
 
+    # The VejmanFakturaTekster groups that each planned equipment type's permissions are checked against
+    groups = {}
     for row in rows:
-        fakturalinjer = row.Fakturalinjer
-        eq_type = row.MaterielIDVejman
-        start_date = row.EarliestStartDate
-        from_end_date = row.EarliestSlutDate
-        
-        equipment_types = [eq_type]  # Use only the current equipment_type
-        
-        # Check if equipment_type is 5
-        if eq_type == 1:
-            equipment_types = [1, 9]  # List of equipment types to iterate over
-
-        if eq_type == 2:
-            equipment_types = [2, 7]  # List of equipment types to iterate over
-            
-        # Iterate through the relevant equipment types
-        for equipment_type in equipment_types:
-            # Fetch permissions data
-            data_frame = FetchVejmanPermissions(token, equipment_type, start_date, from_end_date, orchestrator_connection)
-
-            if data_frame.empty:
-                orchestrator_connection.log_info(f'Ingen rækker for {equipment_type} fra startdato {start_date} og fra slutdato {from_end_date}')
+        for equipment_type in ExpandEquipmentTypes(row.MaterielIDVejman):
+            if equipment_type in fetch_plan:
+                groups.setdefault(equipment_type, []).append(row)
+
+    # Start fetching getcase details as soon as a case shows up in a permission list, over the client's pooled session.
+    # The cases are only parsed once every list is read, since a later list can add targets to a case.
+    # The client adapts how many of the GETCASE_WORKERS threads may have a request in flight
+    writer = None
+    with ThreadPoolExecutor(max_workers=config.GETCASE_WORKERS) as executor:
+        try:
+            futures = {}
+            matched_groups = set()
+
+            with metrics.timer("stage_permission_lists"):
+                for equipment_type, (planned_start_date, planned_end_date) in fetch_plan.items():
+                    # Download each equipment type only once per run, and filter each batch for every group using it
+                    for batch in StreamVejmanPermissions(client, equipment_type, planned_start_date, planned_end_date, orchestrator_connection):
+                        for row in groups[equipment_type]:
+                            data_frame = FilterPermissionWindow(batch, row.EarliestStartDate, row.EarliestSlutDate, fetch_plan[equipment_type])
+                            if data_frame.empty:
+                                continue
+                            matched_groups.add((equipment_type, id(row)))
+                            # Drop permissions that are invoiced, cancelled, not to be invoiced or belong to excluded caseworkers
+                            filtered_rows = filter_cases(data_frame)
+
+                            # Register the filtered rows so each case is only fetched once across equipment types
+                            for case_id in registry.register(filtered_rows, equipment_type, row.Fakturalinjer):
+                                futures[executor.submit(client.get_case, case_id)] = case_id
+
+                    for row in groups[equipment_type]:
+                        if (equipment_type, id(row)) not in matched_groups:
+                            orchestrator_connection.log_info(f'Ingen rækker for {equipment_type} fra startdato {row.EarliestStartDate} og fra slutdato {row.EarliestSlutDate}')
+
+            # Only the VejmanFakturering rows of the registered cases are needed, so the ledger is loaded
+            # once every list is read, while the first getcase requests are still in flight
+            with metrics.timer("sql_select_ledger"):
+                ledger = FakturaLedger.load(conn, registry.case_ids())
+            writer = FakturaWriter(conn, ledger, orchestrator_connection)
+
+            # Check the invoices of all registered cases
+            with metrics.timer("stage_invoices"):
+                FetchInvoice(registry, futures, pricebook, writer, ledger, case_cache, outbox, orchestrator_connection)
+            with metrics.timer("stage_write"):
+                writer.flush()
+                case_cache.commit()
+        except BaseException:
+            # Cancel the queued getcase requests, so the error surfaces once the requests in flight are done
+            executor.shutdown(wait=False, cancel_futures=True)
+            # A rerun sees the stored lines as existing and will not mail them, so their mails are still sent
+            outbox.keep_stored(writer.stored_ids if writer is not None else set())
+            raise
+        orchestrator_connection.log_info(f"{client.limit.summary()}, {client.retry_count} requests retried")
+    case_cache.close()
+    metrics.count("cases", len(registry))
+    metrics.count("cases_skipped", case_cache.skipped_count)
+    metrics.count("rows_unchanged", writer.unchanged_count)
+    return Counter(cases=len(registry), skipped=case_cache.skipped_count, written=writer.written_count, unchanged=writer.unchanged_count)
+
+
+def CaseCacheContext(rows, pricebook: Pricebook):
+    """Cached getcase payloads are only valid for the same invoice texts and pricebook."""
+    return hash_payload([(row.MaterielIDVejman, row.Fakturalinjer) for row in rows], pricebook.fingerprint)
+
+
+def LogRunMetrics(orchestrator_connection: OrchestratorConnection):
+    """Log the structured metrics of the run, and write them to METRICS_EXPORT_PATH if it is set."""
+    run_metrics = metrics.current()
+    orchestrator_connection.log_info(f"Run metrics: {json.dumps(run_metrics.summary())}")
+    if config.METRICS_EXPORT_PATH:
+        run_metrics.export(config.METRICS_EXPORT_PATH)
+
+
+def SendMails(outbox, orchestrator_connection: OrchestratorConnection):
+    """Mail the caseworkers once their lines are stored, so a failed run does not mail them twice."""
+    outbox.send(orchestrator_connection)
+    orchestrator_connection.log_info(f"Sent {outbox.sent_count} discrepancy mails")
+
+
+def LogRunSummary(summary: Counter, orchestrator_connection: OrchestratorConnection):
+    """Log how many cases were checked and invoice lines written."""
+    orchestrator_connection.log_info(f"Skipped {summary['skipped']} of {summary['cases']} cases unchanged since the last run")
+    orchestrator_connection.log_info(f"Upserted {summary['written']} invoice lines, {summary['unchanged']} unchanged lines skipped")
+
+
+class ShardLog:
+    """Stands in for the OrchestratorConnection in a shard process, keeping the log messages for the parent to log."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.messages: list[str] = []
+
+    def log_info(self, message: str):
+        """Keep an info message."""
+        self.messages.append(f"{self.prefix}: {message}")
+
+
+class ShardError(Exception):
+    """Raised in the parent process when a shard fails, carrying the mails of the lines the shard stored before failing.
+    The error of the shard is its cause.
+    """
+
+    def __init__(self, shard_key: str, messages: dict):
+        super().__init__(f"Shard {shard_key} failed")
+        self.shard_key = shard_key
+        self.messages = messages
+
+    def __reduce__(self):
+        # Pickled back to the parent process with the mails, which are left out of the message
+        return ShardError, (self.shard_key, self.messages)
+
+
+def RunShard(fetch_plan, rows, token, pricebook: Pricebook, conn_string, case_cache_mode):
+    """Check one shard of the fetch plan in a worker process with its own HTTP session and database connection.
+
+    Returns:
+        tuple: The shard summary, the queued mails by recipient, the log messages and the metrics of the shard.
+
+    Raises:
+        ShardError: If the shard fails, with the mails that should still be sent.
+    """
+    shard_log = ShardLog("+".join(str(equipment_type) for equipment_type in fetch_plan))
+    shard_metrics = metrics.reset()
+    outbox = Outbox(None)
+    conn = pyodbc.connect(conn_string)
+    try:
+        with VejmanClient(token, log=shard_log.log_info) as client:
+            summary = CheckPermissions(fetch_plan, rows, client, pricebook, conn, case_cache_mode, outbox, shard_log)
+    except Exception as error:
+        raise ShardError(ShardKey(fetch_plan), outbox.messages) from error
+    finally:
+        conn.close()
+    return summary, outbox.messages, shard_log.messages, shard_metrics
+
+
+def RunShards(fetch_plan, rows, token, pricebook: Pricebook, conn_string, arguments, outbox, orchestrator_connection: OrchestratorConnection):
+    """Check the equipment type families of the fetch plan in parallel worker processes, longest first
+    by the case counts of earlier runs, and merge their summaries and mails.
+    If a shard fails, the other shards are finished and the mails of every stored line are merged before its ShardError is raised.
+    """
+    shards = [
+        {equipment_type: fetch_plan[equipment_type] for equipment_type in family}
+        for family in GroupEquipmentTypes(rows)
+    ]
+    history = ReadShardHistory()
+    # Shards without history are scheduled first, since they may be the longest
+    shards.sort(key=lambda shard: history.get(ShardKey(shard), float('inf')), reverse=True)
+
+    # The cache is cleared once here, so a shard starting late does not clear what earlier shards stored
+    CaseCache(mode=arguments.case_cache, context=CaseCacheContext(rows, pricebook)).close()
+    case_cache_mode = "use" if arguments.case_cache == "rebuild" else arguments.case_cache
+
+    summary = Counter()
+    errors = []
+    with ProcessPoolExecutor(max_workers=min(arguments.processes, len(shards))) as executor:
+        futures = {
+            executor.submit(RunShard, shard, rows, token, pricebook, conn_string, case_cache_mode): ShardKey(shard)
+            for shard in shards
+        }
+        for future in as_completed(futures):
+            try:
+                shard_summary, messages, log_messages, shard_metrics = future.result()
+            except ShardError as error:
+                errors.append(error)
+                outbox.merge(error.messages)
                 continue
-            # Clean authority_reference_number column
-            data_frame['cleaned_authority_reference_number'] = data_frame['authority_reference_number'].apply(
-                lambda x: re.sub(r'[^\x20-\x7E]', '', str(x).strip().lower()) if pd.notnull(x) else ''
-            )
-
-            # Filter rows based on substring checks for 'faktura sendt' and 'faktureres ikke', and exact match for 'fak'
-            filtered_rows = data_frame[
-                ~(
-                    data_frame['cleaned_authority_reference_number'].str.contains('faktura sendt') | 
-                    data_frame['cleaned_authority_reference_number'].str.contains('faktureres ikke') | 
-                    data_frame['cleaned_authority_reference_number'].str.contains('annulleret') | 
-                    (data_frame['cleaned_authority_reference_number'] == 'fak')
-                ) & 
-                (data_frame['initials'] != 'JADT')
-            ]
+            metrics.current().merge(shard_metrics)
+            for message in log_messages:
+                orchestrator_connection.log_info(message)
+            outbox.merge(messages)
+            history[futures[future]] = shard_summary['cases']
+            summary += shard_summary
 
+    if errors:
+        raise errors[0]
+    WriteShardHistory(history)
+    orchestrator_connection.log_info(f"Checked {len(shards)} shards in {min(arguments.processes, len(shards))} processes")
+    return summary
 
-            # Fetch invoices for filtered rows
-            FetchInvoice(filtered_rows, token, pricebook_map, equipment_type, fakturalinjer, conn, faktura_db, developer_email, orchestrator_connection)
-    orchestrator_connection.update_constant("VejmanKassenSynkroniseret", datetime.now().strftime("%d-%m-%Y %H:%M"))
 
-def FetchVejmanPermissions(token, equipment_type, fra_startdato, fra_slutdato, orchestrator_connection: OrchestratorConnection):
+def ShardKey(shard):
+    """Get the key of a shard or fetch plan, used in the shard history and as its case cache scope."""
+    return "+".join(str(equipment_type) for equipment_type in sorted(shard))
 
-    combined_cases = []
 
-    # Initialize an HTTP client
-    with requests.Session() as client:
-        # Modify the URL for each equipment type
-        url = f"https://vejman.vd.dk/permissions/getcases?pmCaseStates=8&pmCaseFields=state%2Ctype%2Ccase_number%2Cauthority_reference_number%2Cstart_date%2Cstreet_name%2Ccvr_number%2Capplicant%2Cend_date%2Ccompletion_date%2Cauto_completedcontractor%2Cinitials&pmCaseWorker=all&pmCaseTypes=%27rovm%27&pmCaseVariant=all&pmCaseTags=ignorerTags&pmCaseTagShow=&pmCaseShowAttachments=false&pmAllStates=&dontincludemap=1&authority=751&cse=&equipmentType={equipment_type}&startDateFrom={fra_startdato}&startDateTo={datetime.today().strftime('%Y-%m-%d')}&endDateFrom={fra_slutdato}&policeDistrictShow=&_={int(time.time() * 1000)}&token={token}"
+def ReadShardHistory():
+    """Get the number of cases each shard checked in the last sharded run."""
+    try:
+        with open(config.SHARD_HISTORY_PATH, encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
 
-        response = client.get(url, timeout = 500)
-        response.raise_for_status()
-        json_object = response.json()
 
-        cases = json_object["cases"]
+def WriteShardHistory(history):
+    """Store the number of cases each shard checked for scheduling the next sharded run."""
+    with open(config.SHARD_HISTORY_PATH, "w", encoding="utf-8") as file:
+        json.dump(history, file)
 
-        # Combine the cases into one list
-        combined_cases.extend(cases)
 
-    # Assuming combined_cases is not empty
-    if combined_cases:
-        # Create a DataFrame from the combined cases
-        data_frame = pd.DataFrame(combined_cases)
-    else:
+def GroupEquipmentTypes(rows):
+    """Split the equipment types of the VejmanFakturaTekster groups into families that share a group,
+    e.g. 1 and 9, so a case listed under several of them is still checked by one worker.
+    """
+    families = []
+    for row in rows:
+        family = set(ExpandEquipmentTypes(row.MaterielIDVejman))
+        for other in [other for other in families if other & family]:
+            family |= other
+            families.remove(other)
+        families.append(family)
+    return [sorted(family) for family in families]
+
+
+def DispatchWorkItems(fetch_plan, rows, sync_started, full_sync, orchestrator_connection: OrchestratorConnection):
+    """Publish a queue element per equipment type family to QUEUE_NAME, holding the getcases windows to check
+    and what CompleteDispatchedSync needs to record the sync once every element is done.
+    """
+    families = GroupEquipmentTypes(rows)
+    references = [
+        f"{sync_started.strftime('%d-%m-%Y %H:%M')} type {'+'.join(str(equipment_type) for equipment_type in equipment_types)}"
+        for equipment_types in families
+    ]
+    data = []
+    for equipment_types in families:
+        data.append(json.dumps({
+            "windows": {str(equipment_type): [str(fetch_plan[equipment_type][0]), str(fetch_plan[equipment_type][1])] for equipment_type in equipment_types},
+            "sync_started": sync_started.strftime("%d-%m-%Y %H:%M"),
+            "full_sync": full_sync,
+            "references": references,
+        }))
+    orchestrator_connection.bulk_create_queue_elements(config.QUEUE_NAME, tuple(references), tuple(data), created_by=orchestrator_connection.process_name)
+    orchestrator_connection.log_info(f"Dispatched {len(references)} work items to {config.QUEUE_NAME}")
+
+
+def ParseWorkItem(queue_element: QueueElement, rows) -> WorkItem:
+    """Get the fetch plan and dispatch details of a work item published by DispatchWorkItems.
+    Raises BusinessError if it is malformed or names an equipment type no VejmanFakturaTekster group covers any more,
+    so a bad element fails before any rows are written.
+    """
+    try:
+        data = json.loads(queue_element.data)
+        fetch_plan = {int(equipment_type): (window[0], window[1]) for equipment_type, window in data["windows"].items()}
+        sync_started = datetime.strptime(data["sync_started"], "%d-%m-%Y %H:%M")
+        full_sync = data["full_sync"]
+        references = data["references"]
+        if not isinstance(full_sync, bool) or not isinstance(references, list) or not all(isinstance(reference, str) for reference in references):
+            raise TypeError("full_sync must be a bool and references a list of strings")
+    except (TypeError, ValueError, KeyError, IndexError, AttributeError) as error:
+        raise BusinessError(f"Invalid work item {queue_element.reference}: {queue_element.data}") from error
+
+    # VejmanFakturaTekster may have changed since the work item was dispatched
+    known_types = {equipment_type for row in rows for equipment_type in ExpandEquipmentTypes(row.MaterielIDVejman)}
+    unknown_types = sorted(set(fetch_plan) - known_types)
+    if unknown_types:
+        raise BusinessError(f"Work item {queue_element.reference} has equipment types {unknown_types} that are no longer in VejmanFakturaTekster")
+    return WorkItem(fetch_plan, sync_started, full_sync, references)
+
+
+def CompleteDispatchedSync(queue_element: QueueElement, work_item: WorkItem, orchestrator_connection: OrchestratorConnection):
+    """Advance the sync constants to the dispatch time of a work item once every work item of its dispatch is done,
+    so cases of a failed work item are fetched again by the next sync.
+    The element being processed is still in progress, so only the last worker to finish sees all the others done.
+    If two workers finish at the same time neither may advance them, and the next run syncs from the older watermark.
+    """
+    for reference in work_item.references:
+        if reference == queue_element.reference:
+            continue
+        elements = orchestrator_connection.get_queue_elements(config.QUEUE_NAME, reference=reference, limit=1)
+        if not elements or elements[0].status != QueueStatus.DONE:
+            orchestrator_connection.log_info(f"Work item {reference} is not done, leaving the sync constants to the last worker")
+            return
+
+    AdvanceSyncConstants(work_item.sync_started, work_item.full_sync, orchestrator_connection)
+
+
+def AdvanceSyncConstants(sync_started, full_sync, orchestrator_connection: OrchestratorConnection):
+    """Record a completed sync as the watermark of the next incremental run, and as the last full sweep if it was one."""
+    orchestrator_connection.update_constant("VejmanKassenSynkroniseret", sync_started.strftime("%d-%m-%Y %H:%M"))
+    if full_sync:
+        try:
+            orchestrator_connection.update_constant(config.FULL_SYNC_CONSTANT, sync_started.strftime("%d-%m-%Y %H:%M"))
+        except ValueError:
+            orchestrator_connection.log_info(f"Constant {config.FULL_SYNC_CONSTANT} does not exist, the next run will also be a full sync")
+
+
+def ExpandEquipmentTypes(eq_type):
+    """Get the Vejman equipment types a VejmanFakturaTekster group covers."""
+    if eq_type == 1:
+        return [1, 9]
+    if eq_type == 2:
+        return [2, 7]
+    return [eq_type]
+
+
+def GetSyncWatermark(force_full_sync, orchestrator_connection: OrchestratorConnection):
+    """Get the time of the last successful sync to fetch incrementally from.
+    Returns None when a full reconciliation sweep should be run instead, i.e. when incremental sync is
+    disabled or forced off, or when the last full sweep is missing or older than FULL_SYNC_INTERVAL_DAYS.
+    """
+    if not config.INCREMENTAL_SYNC or force_full_sync:
+        orchestrator_connection.log_info("Running full sync")
+        return None
+
+    try:
+        watermark = datetime.strptime(orchestrator_connection.get_constant("VejmanKassenSynkroniseret").value, "%d-%m-%Y %H:%M")
+        last_full_sync = datetime.strptime(orchestrator_connection.get_constant(config.FULL_SYNC_CONSTANT).value, "%d-%m-%Y %H:%M")
+    except ValueError:
+        orchestrator_connection.log_info("No valid sync watermark, running full sync")
+        return None
+
+    if datetime.now() - last_full_sync >= timedelta(days=config.FULL_SYNC_INTERVAL_DAYS):
+        orchestrator_connection.log_info(f"Last full sync was {last_full_sync}, running full sync")
+        return None
+
+    orchestrator_connection.log_info(f"Running incremental sync from watermark {watermark}")
+    return watermark
+
+
+def PlanPermissionFetches(rows, watermark=None):
+    """Merge the (equipment_type, start, end) windows requested by all VejmanFakturaTekster groups
+    into one window per equipment type, so each permission list only has to be fetched once.
+
+    The getcases listing cannot filter on modification time, so an incremental run instead skips
+    cases that ended more than INCREMENTAL_LOOKBACK_DAYS before the watermark. Those were already
+    handled by earlier runs, and later edits to them are caught by the periodic full sweep.
+
+    Returns:
+        dict: The earliest start date and earliest end date to fetch, keyed by equipment type.
+    """
+    fetch_plan = {}
+    for row in rows:
+        for equipment_type in ExpandEquipmentTypes(row.MaterielIDVejman):
+            window = (row.EarliestStartDate, row.EarliestSlutDate)
+            if equipment_type in fetch_plan:
+                planned_start_date, planned_end_date = fetch_plan[equipment_type]
+                window = (min(planned_start_date, window[0]), min(planned_end_date, window[1]))
+            fetch_plan[equipment_type] = window
+
+    if watermark is not None:
+        incremental_end_date = (watermark - timedelta(days=config.INCREMENTAL_LOOKBACK_DAYS)).date()
+        for equipment_type, (planned_start_date, planned_end_date) in fetch_plan.items():
+            if pd.Timestamp(planned_end_date).date() < incremental_end_date:
+                fetch_plan[equipment_type] = (planned_start_date, incremental_end_date.strftime('%Y-%m-%d'))
+    return fetch_plan
+
+
+def FilterPermissionWindow(data_frame: pd.DataFrame, start_date, from_end_date, planned_window):
+    """Narrow a cached permission list down to the window a single group asked for."""
+    if data_frame.empty or (start_date, from_end_date) == planned_window:
+        return data_frame
+    case_start_dates = pd.to_datetime(data_frame['start_date'], format="%d-%m-%Y", errors='coerce')
+    case_end_dates = pd.to_datetime(data_frame['end_date'], format="%d-%m-%Y", errors='coerce')
+    return data_frame[(case_start_dates >= pd.Timestamp(start_date)) & (case_end_dates >= pd.Timestamp(from_end_date))]
+
+
+def StreamVejmanPermissions(client: VejmanClient, equipment_type, fra_startdato, fra_slutdato, orchestrator_connection: OrchestratorConnection):
+    """Yield the permissions of an equipment type in DataFrames of up to PERMISSION_BATCH_SIZE cases.
+    With STREAM_PERMISSIONS the cases array is parsed while the response downloads,
+    so only one batch of the list is held in memory at a time.
+    """
+    with client.get_cases(equipment_type, fra_startdato, fra_slutdato, stream=config.STREAM_PERMISSIONS) as response:
+        if config.STREAM_PERMISSIONS:
+            cases = iter_json_array(response.iter_content(chunk_size=config.PERMISSION_STREAM_CHUNK_SIZE), "cases", response.encoding or "utf-8")
+        else:
+            cases = iter(response.json()["cases"])
+
+        case_count = 0
+        while batch := list(itertools.islice(cases, config.PERMISSION_BATCH_SIZE)):
+            case_count += len(batch)
+            yield pd.DataFrame(batch)
+
+    if case_count == 0:
         orchestrator_connection.log_info("No new permissions")
-        data_frame = pd.DataFrame()
-    return data_frame
 
-def FetchPricebookData(token):
-    url = f"https://vejman.vd.dk/services/data.do?table=v_h_pm_pricebook&token={token}"
-    response = requests.get(url)
-    response.raise_for_status()
-    pricebook_data = response.json().get('data', [])
-    pricebook_map = {item['text']: item for item in pricebook_data}
-    return pricebook_map
+def FetchPricebookData(client: VejmanClient):
+    """Get the pricebook from the local snapshot, refreshing it from Vejman when it is older than PRICEBOOK_TTL_HOURS."""
+    return load_pricebook(client)
 
 
 def append_to_mail_body(mail_body, append_text):
@@ -144,7 +522,71 @@ def append_to_mail_body(mail_body, append_text):
     mail_body += append_text
     return mail_body
 
-def SendEmail(to_address: str | list[str], subject: str, body: str, bcc: str):
+class Outbox:
+    """Collects the discrepancy mails of a run so they can be sent together at the end.
+    With EMAIL_DIGEST the mails of each caseworker are combined into one digest,
+    otherwise every permit keeps its own mail.
+    """
+
+    def __init__(self, bcc: str, digest: bool = config.EMAIL_DIGEST):
+        self.bcc = bcc
+        self.digest = digest
+        self.messages: dict[str, list[tuple[str, str, list[str]]]] = {}
+        self.sent_count = 0
+
+    def add(self, to_address: str, tilladelse_nr, body: str, faktura_ids: list[str]):
+        """Queue the discrepancy mail of a permit, with the VejmanFakturaIDs of the lines it is about."""
+        self.messages.setdefault(to_address, []).append((tilladelse_nr, body, faktura_ids))
+
+    def merge(self, messages: dict):
+        """Queue the mails of another outbox, e.g. of a shard."""
+        for to_address, permits in messages.items():
+            self.messages.setdefault(to_address, []).extend(permits)
+
+    def keep_stored(self, stored_ids: set[str]):
+        """Drop the mails of permits none of whose lines were stored, e.g. when the run failed before writing them.
+        A rerun mails those again, while the mails of stored lines are not sent by a rerun.
+        """
+        for to_address in list(self.messages):
+            permits = [permit for permit in self.messages[to_address] if any(faktura_id in stored_ids for faktura_id in permit[2])]
+            if permits:
+                self.messages[to_address] = permits
+            else:
+                del self.messages[to_address]
+
+    def build_messages(self) -> list[EmailMessage]:
+        """Build the mails to send, one per caseworker or one per permit."""
+        messages = []
+        for to_address, permits in self.messages.items():
+            if self.digest and len(permits) > 1:
+                body = "<br><br><hr><br>".join(permit_body for _, permit_body, _ in permits)
+                messages.append(BuildEmail(to_address, f"Uoverensstemmelser for fakturering på {len(permits)} tilladelser", body, self.bcc))
+            else:
+                messages.extend(
+                    BuildEmail(to_address, f"Uoverensstemmelser for fakturering på tilladelse {tilladelse_nr}", body, self.bcc)
+                    for tilladelse_nr, body, _ in permits
+                )
+        return messages
+
+    def send(self, orchestrator_connection: OrchestratorConnection):
+        """Send all queued mails over one SMTP connection. A mail that is refused is logged and skipped."""
+        messages = self.build_messages()
+        if not messages:
+            return
+
+        with metrics.timer("smtp"), smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT) as smtp:
+            smtp.starttls()
+            for msg in messages:
+                try:
+                    smtp.send_message(msg)
+                    self.sent_count += 1
+                    metrics.count("mails_sent")
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as error:
+                    orchestrator_connection.log_info(f"Could not send '{msg['subject']}' to {msg['to']}: {error}")
+        self.messages.clear()
+
+
+def BuildEmail(to_address: str | list[str], subject: str, body: str, bcc: str) -> EmailMessage:
     msg = EmailMessage()
     msg['to'] = to_address
     msg['from'] = "VejmanFakturaRobot <noreply@aarhus.dk>"
@@ -153,224 +595,244 @@ def SendEmail(to_address: str | list[str], subject: str, body: str, bcc: str):
 
     msg.set_content("Please enable HTML to view this message.")
     msg.add_alternative(body, subtype='html')
-
-    # Send message
-    with smtplib.SMTP(config.SMTP_SERVER, config.SMTP_PORT) as smtp:
-        smtp.starttls()
-        smtp.send_message(msg)
+    return msg
 
 
-def FetchInvoice(data_frame: pd.DataFrame, token, pricebook_map, equipment_type, fakturalinjer, conn, faktura_db, developer_email, orchestrator_connection: OrchestratorConnection):
+def FetchInvoice(registry: CaseRegistry, futures: dict, pricebook: Pricebook, writer: FakturaWriter, ledger: FakturaLedger, case_cache: CaseCache, outbox: Outbox, orchestrator_connection: OrchestratorConnection):
     locale.setlocale(locale.LC_NUMERIC, 'da_DK')
+
+    # Matched lines are validated in batches of VALIDATION_BATCH_SIZE case/Fakturalinje groups
+    targets = []
+    lines = []
+
+    # Collect the lines of each case as soon as its getcase details arrive.
+    # Each future is dropped once consumed, so its payload is freed with the case instead of at the end of the run
+    for future in as_completed(futures):
+        case_id = futures.pop(future)
+        json_object = future.result()
+        row = registry.row(case_id)
+
+        # Skip cases that look exactly like they did in the last successful run
+        payload_hash = hash_payload(json_object, row, registry.targets(case_id))
+        if case_cache.is_unchanged(case_id, payload_hash, ledger):
+            continue
+
+        collected_ids = set()
+        case = ParseCase(row, json_object, orchestrator_connection)
+        if case is not None:
+            # Fan the parsed case out to every equipment type and Fakturalinje group that listed it
+            for equipment_type, fakturalinjer in registry.targets(case_id):
+                case_lines = CollectInvoiceLines(case, equipment_type, fakturalinjer, len(targets), ledger, orchestrator_connection)
+                if case_lines is not None:
+                    targets.append((case, equipment_type))
+                    lines.extend(case_lines)
+                    collected_ids.update(str(line['VejmanFakturaID']) for line in case_lines)
+
+        invoice_details = (json_object.get('invoice') or {}).get('details', [])
+        faktura_ids = [detail.get('id') for detail in invoice_details if detail.get('id') in ledger or str(detail.get('id')) in collected_ids]
+        case_cache.stage(case_id, payload_hash, json_object, faktura_ids)
+
+        if len(targets) >= config.VALIDATION_BATCH_SIZE:
+            ValidateInvoiceBatch(targets, lines, pricebook, writer, outbox, orchestrator_connection)
+            targets = []
+            lines = []
+
+    ValidateInvoiceBatch(targets, lines, pricebook, writer, outbox, orchestrator_connection)
+
+
+def ParseCase(row, json_object, orchestrator_connection: OrchestratorConnection):
+    """Extract everything needed to check the invoice lines of a case from its getcases row and getcase details.
+    Returns None if the case has no invoice.
+    """
+    mail_body = ""
+    # Extract necessary variables
+    case_id = row['case_id']
+    case_number = row['case_number']
+    orchestrator_connection.log_info(f"Checking {case_number} - https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}")            
+
+    start_date = datetime.strptime(row.get('start_date', ''), "%d-%m-%Y")
+    end_date = datetime.strptime(row.get('end_date', ''), "%d-%m-%Y")
+    completion_date = datetime.strptime(row.get('completion_date', ''), "%d-%m-%Y")
+    auto_completed = row.get('auto_completed')
+    #cvr_number = row.get('cvr_number')
+    cvr_number = None
+    applicant = row.get('applicant')
+    tilladelse_nr = case_number
+    address = row['street_name']
+
     
-    with requests.Session() as client:
-        for index, row in data_frame.iterrows():
-            mail_body = ""
-            # Extract necessary variables
-            case_id = row['case_id']
-            case_number = row['case_number']
-            orchestrator_connection.log_info(f"Checking {case_number} - https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}")            
-
-            start_date = datetime.strptime(row.get('start_date', ''), "%d-%m-%Y")
-            end_date = datetime.strptime(row.get('end_date', ''), "%d-%m-%Y")
-            completion_date = datetime.strptime(row.get('completion_date', ''), "%d-%m-%Y")
-            auto_completed = row.get('auto_completed')
-            #cvr_number = row.get('cvr_number')
-            applicant = row.get('applicant')
-            tilladelse_nr = case_number
-            address = row['street_name']
-
-            
-            # Fetch detailed case data
-            response = client.get(f"https://vejman.vd.dk/permissions/getcase?caseid={case_id}&token={token}", timeout=500)
-            response.raise_for_status()
-            json_object = response.json().get('data')
-            caseworker_email = json_object['authEmail']
-
-            # Check if there's an invoice in the JSON object
-            invoice_data = json_object.get('invoice', {})
-            
-            if invoice_data:         
-                # Get invoice role, select 1 (ansøger) if no role selected
-                invoice_role_id = invoice_data.get('role', {}).get('id', 1)
-                att = "Intet navn angivet"
-                # Get name for ATT and update the cvr_number if not found in the main DataFrame
-                contacts = json_object.get('contacts', [])
-                for contact in contacts:
-                    # Check if this contact has a role matching the invoice role id
-                    roles = contact.get("roles", [])
-                    if any(role.get("role", {}).get("id") == invoice_role_id for role in roles):
-                        # Combine name components
-                        name_parts = [
-                            contact.get("given_name", ""),
-                            contact.get("middle_name", ""),
-                            contact.get("surname", ""),
-                        ]
-                        combined_name = " ".join(part for part in name_parts if part)
-                        if combined_name:
-                            att = f"Att: {combined_name}"  # Set att with the combined name                 
-                        applicant = contact.get('company_name')
-                        cvr_number = contact.get("cvr_number")
-                        break  # Exit loop once the matching contact is processed
-
-                if not cvr_number:
-                    orchestrator_connection.log_info("Intet CVR nummer")
-                    mail_body = append_to_mail_body(mail_body, f'Der er intet CVR nummer angivet for faktura modtager på tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a>.')
-                    cvr_number = '00000000'
-                else:
-                    if re.fullmatch(r'\d{8}', cvr_number) is None:
-                        orchestrator_connection.log_info("Forkert angivet CVR nummer")
-                        mail_body = append_to_mail_body(mail_body, f'CVR nummer er angivet som {cvr_number} for faktura modtager på tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a>, men det burde være udelukkende 8 cifre. Check venligst om det er angivet korrekt og om der er skjulte tegn eller mellemrum.')
-                        cvr_number = '00000000'
-                invoice_details = invoice_data.get('details', [])
-                # Iterate through each invoice detail and extract relevant information
-                Matches = False
-                AlreadyCreated = False
-                for detail in invoice_details:
-                    
-                    detail_text = detail.get('text')
-                    # Check if detail_text exists in the Fakturalinje column
-                    VejmanFakturaID = detail.get('id')
-                    
-                    # Access columns by name
-                    matching_row = next(
-                        (row for row in faktura_db if row.VejmanFakturaID == VejmanFakturaID),
-                        None
-                    )        
-                    if matching_row and (matching_row.Faktureret == 1 or matching_row.SendTilFakturering == 1 or matching_row.FakturerIkke == 1):
-                        orchestrator_connection.log_info("Row already sent to invoice, deleted or has been invoiced, skipping.")
-                        continue           
-                    matched_fakturalinje = None
-                    
-                    for f in fakturalinjer.split(','):
-                        if f.strip().lower() in detail_text.strip().lower():
-                            orchestrator_connection.log_info(f"Match found for Fakturalinje: {detail_text} with MaterielIDVejman = {equipment_type}: {f}")
-                            Matches = True
-                            matched_fakturalinje = f  # Assign the matching Fakturalinje
-                            break  # Break inner loop when match is found
-
-                    if matched_fakturalinje:
-                        # Do something with the matched Fakturalinje
-                        Fakturalinje = matched_fakturalinje
-                    else:
-                        orchestrator_connection.log_info(f"No match found for Fakturalinje: {detail_text} with MaterielIDVejman = {equipment_type}")
-                        continue  # Continue to next detail if no match
-                    pricebook_entry = pricebook_map.get(detail_text, {})
-                    
-                    if matching_row:
-                        AlreadyCreated = True
-                        orchestrator_connection.log_info("Row already exists, updating without replacing dates")
-                        # Fetch Startdato and Slutdato from the SQL row if it exists
-                        start_date = datetime.strptime(matching_row.Startdato, "%Y-%m-%d")
-                        end_date = datetime.strptime(matching_row.Slutdato, "%Y-%m-%d")
-                        chosen_end_date = end_date
-                        completion_date = end_date
-                    else:
-                        orchestrator_connection.log_info("No matching row")
-                        # Check if autocompleted, if so then end_date, if not check if completion_date is lesser than end_date, else use end_date
-                        chosen_end_date = end_date if auto_completed == "AF" else min(completion_date, end_date) if completion_date and end_date else end_date
-                    
-                    
-                    if start_date and chosen_end_date:
-                        # Convert both to date objects, ignoring time part
-                        days_difference = (chosen_end_date.date() - start_date.date()).days
-                        
-                        # Add 1 to count both start and end dates (as in the example provided)
-                        days_period = days_difference + 1
+    # Detailed case data as returned by getcase
+    caseworker_email = json_object['authEmail']
+
+    # Check if there's an invoice in the JSON object
+    invoice_data = json_object.get('invoice', {})
+    
+    if not invoice_data:
+        orchestrator_connection.log_info(f"No invoices found for case ID: {case_id}")
+        return None
+
+    # Get invoice role, select 1 (ansøger) if no role selected
+    invoice_role_id = invoice_data.get('role', {}).get('id', 1)
+    att = "Intet navn angivet"
+    # Get name for ATT and update the cvr_number if not found in the main DataFrame
+    contacts = json_object.get('contacts', [])
+    for contact in contacts:
+        # Check if this contact has a role matching the invoice role id
+        roles = contact.get("roles", [])
+        if any(role.get("role", {}).get("id") == invoice_role_id for role in roles):
+            # Combine name components
+            name_parts = [
+                contact.get("given_name", ""),
+                contact.get("middle_name", ""),
+                contact.get("surname", ""),
+            ]
+            combined_name = " ".join(part for part in name_parts if part)
+            if combined_name:
+                att = f"Att: {combined_name}"  # Set att with the combined name                 
+            applicant = contact.get('company_name')
+            cvr_number = contact.get("cvr_number")
+            break  # Exit loop once the matching contact is processed
+
+    if not cvr_number:
+        orchestrator_connection.log_info("Intet CVR nummer")
+        mail_body = append_to_mail_body(mail_body, f'Der er intet CVR nummer angivet for faktura modtager på tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a>.')
+        cvr_number = '00000000'
+    else:
+        if re.fullmatch(r'\d{8}', cvr_number) is None:
+            orchestrator_connection.log_info("Forkert angivet CVR nummer")
+            mail_body = append_to_mail_body(mail_body, f'CVR nummer er angivet som {cvr_number} for faktura modtager på tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a>, men det burde være udelukkende 8 cifre. Check venligst om det er angivet korrekt og om der er skjulte tegn eller mellemrum.')
+            cvr_number = '00000000'
+
+    return {
+        'case_id': case_id,
+        'tilladelse_nr': tilladelse_nr,
+        'address': address,
+        'start_date': start_date,
+        'end_date': end_date,
+        'completion_date': completion_date,
+        'auto_completed': auto_completed,
+        'applicant': applicant,
+        'cvr_number': cvr_number,
+        'att': att,
+        'caseworker_email': caseworker_email,
+        'connected_case': json_object.get('connected_case'),
+        'invoice_details': invoice_data.get('details', []),
+        'mail_body': mail_body,
+    }
+
+
+def CollectInvoiceLines(case, equipment_type, fakturalinjer, target, ledger: FakturaLedger, orchestrator_connection: OrchestratorConnection):
+    """Match the invoice details of a parsed case against one equipment type and Fakturalinje group.
+    Returns the lines to validate, or None if no detail matched the group.
+    """
+    tilladelse_nr = case['tilladelse_nr']
+    invoice_details = case['invoice_details']
+    lines = []
+    Matches = False
+    # Match all detail texts of the case against the group's compiled Fakturalinjer in one pass
+    detail_matches = get_matcher(fakturalinjer).match_all([detail.get('text') for detail in invoice_details])
+    for detail, matched_fakturalinje in zip(invoice_details, detail_matches):
+        detail_text = detail.get('text')
+        VejmanFakturaID = detail.get('id')
+
+        matching_row = ledger.get(VejmanFakturaID)
+        if matching_row and matching_row.is_final:
+            orchestrator_connection.log_info("Row already sent to invoice, deleted or has been invoiced, skipping.")
+            continue
+
+        if matched_fakturalinje is not None:
+            orchestrator_connection.log_info(f"Match found for Fakturalinje: {detail_text} with MaterielIDVejman = {equipment_type}: {matched_fakturalinje}")
+            Matches = True
+        if not matched_fakturalinje:
+            orchestrator_connection.log_info(f"No match found for Fakturalinje: {detail_text} with MaterielIDVejman = {equipment_type}")
+            continue  # Continue to next detail if no match
+
+        if matching_row:
+            orchestrator_connection.log_info("Row already exists, updating without replacing dates")
+        else:
+            orchestrator_connection.log_info("No matching row")
+
+        lines.append({
+            'target': target,
+            'fakturalinje': matched_fakturalinje,
+            'VejmanFakturaID': VejmanFakturaID,
+            'detail_text': detail_text,
+            'detail_unit_price': detail.get('unit_price', 0),
+            'price': detail.get('price', 0),
+            'units': detail.get('units'),
+            'existing': matching_row is not None,
+            'ledger_start': matching_row.Startdato if matching_row else None,
+            'ledger_end': matching_row.Slutdato if matching_row else None,
+            'start_date': case['start_date'],
+            'end_date': case['end_date'],
+            'completion_date': case['completion_date'],
+            'auto_completed': case['auto_completed'],
+            'connected_case': case['connected_case'],
+        })
+
+    if not Matches:
+        orchestrator_connection.log_info(f"No invoice line matches for {tilladelse_nr}")
+        return None
+    return lines
+
+
+def ValidateInvoiceBatch(targets, lines, pricebook, writer: FakturaWriter, outbox: Outbox, orchestrator_connection: OrchestratorConnection):
+    """Validate the prices of a batch of collected lines, queue them for upsert and queue mails to the
+    caseworkers of new lines with discrepancies.
+
+    Args:
+        targets: (case, equipment_type) for every case/Fakturalinje group with matches, indexed by the lines' target.
+        lines: The lines returned by CollectInvoiceLines.
+    """
+    if not targets:
+        return
+
+    with metrics.timer("stage_validation"):
+        validated = validate_invoice_lines(lines, pricebook)
+    target_lines = dict(iter(validated.groupby('target', sort=False))) if not validated.empty else {}
+
+    for target, (case, equipment_type) in enumerate(targets):
+        case_id = case['case_id']
+        tilladelse_nr = case['tilladelse_nr']
+        mail_body = case['mail_body']
+        group = target_lines.get(target)
+        AlreadyCreated = group is not None and bool(group['existing'].any())
+
+        for line in (group.itertuples(index=False) if group is not None else []):
+            Fakturalinje = line.fakturalinje
+            start_date = line.start
+            chosen_end_date = line.chosen_end
+            end_date = line.mail_end
+
+            if line.mismatch:
+                mail_body = append_to_mail_body(mail_body, f'Der er uoverensstemmelse mellem de angivne værdier på tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a> for fakturalinjnen med teksten {Fakturalinje}. Robotten har opdaget følgende:')
+                orchestrator_connection.log_info(str(line.total_calculated_price)+" - "+str(line.price)+f" {line.length} <> {line.calculated_length}, {line.days_period} <> {line.units}")
+                if line.length_mismatch:
+                    mail_body = append_to_mail_body(mail_body, f'Længden/m2 er opgivet til {line.length}, men ud fra fakturalinjen udregnes længden/m2 til at være {line.calculated_length} hvis enhedsprisen er på {line.unit_price}. Du skal derfor rette fakturalinjen eller sørge for at længden/m2 er angivet korrekt i "Relateret sag" feltet. Sørg for kun at have længden eller m2 værdien stående i relateret sag for at robotten kan læse det korrekt, og f.eks. ikke udregningen af kvadratmeter. Hvis der er flere fakturalinjer på tilladelsen med forskellige længder må du rette dem til i Vejmankassen når du sender dem til fakturering.')
+                if line.days_mismatch:
+                    if line.completion_used:
+                        mail_body = append_to_mail_body(mail_body, f'Antal af dage er angivet til {line.units} i fakturalinjen, men ud fra startdato og færdigmeldingsdato udregnes antallet af dage fra {start_date.strftime("%d-%m-%Y")} til og med {chosen_end_date.strftime("%d-%m-%Y")} til at være {line.days_period} dage. Færdigmeldingsdatoen {chosen_end_date.strftime("%d-%m-%Y")} benyttes da den er angivet til at være færdig før slutdatoen som er sat til {end_date.strftime("%d-%m-%Y")}.')
                     else:
-                        days_period = None
-
-
-                    # Handle cases where unit_price can be a string or a float
-                    raw_detail_unit_price = detail.get('unit_price', 0)
-                    if isinstance(raw_detail_unit_price, str):
-                        raw_detail_unit_price = float(raw_detail_unit_price.replace(",", "."))
-                    detail_unit_price = raw_detail_unit_price
-
-                    unit_price = pricebook_entry.get('unit_price', 0)
-                    unit_price = float(unit_price)
-
-                    try:
-                        match = re.search(r'\d+(\.\d+)?', str(json_object['connected_case']).replace(",","."))
-                        length = float(match.group()) if match else 0
-                    except:
-                        length = 0
-                    
-                    total_calculated_price = round(days_period * (unit_price * length),2) if days_period is not None else None
-                    
-                    # Compare the calculated price with the actual price in the detail
-                    price_match_status = "MATCH" if total_calculated_price and abs(total_calculated_price - detail.get('price', 0)) <= 0.01 else "MISMATCH"
-                    
-                    if price_match_status == 'MISMATCH':
-                        days_written = detail.get('units')
-                        calculated_length = round(detail_unit_price / unit_price,2) if unit_price else 0
-                        mail_body = append_to_mail_body(mail_body, f'Der er uoverensstemmelse mellem de angivne værdier på tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a> for fakturalinjnen med teksten {Fakturalinje}. Robotten har opdaget følgende:')
-                        orchestrator_connection.log_info(str(total_calculated_price)+" - "+str(detail.get('price', 0))+f" {length} <> {calculated_length}, {days_period} <> {days_written}")
-                        if length != calculated_length:
-                            mail_body = append_to_mail_body(mail_body, f'Længden/m2 er opgivet til {length}, men ud fra fakturalinjen udregnes længden/m2 til at være {calculated_length} hvis enhedsprisen er på {unit_price}. Du skal derfor rette fakturalinjen eller sørge for at længden/m2 er angivet korrekt i "Relateret sag" feltet. Sørg for kun at have længden eller m2 værdien stående i relateret sag for at robotten kan læse det korrekt, og f.eks. ikke udregningen af kvadratmeter. Hvis der er flere fakturalinjer på tilladelsen med forskellige længder må du rette dem til i Vejmankassen når du sender dem til fakturering.')
-                        if days_period != days_written:
-                            if chosen_end_date != end_date:
-                                mail_body = append_to_mail_body(mail_body, f'Antal af dage er angivet til {days_written} i fakturalinjen, men ud fra startdato og færdigmeldingsdato udregnes antallet af dage fra {start_date.strftime("%d-%m-%Y")} til og med {chosen_end_date.strftime("%d-%m-%Y")} til at være {days_period} dage. Færdigmeldingsdatoen {chosen_end_date.strftime("%d-%m-%Y")} benyttes da den er angivet til at være færdig før slutdatoen som er sat til {end_date.strftime("%d-%m-%Y")}.')
-                            else:
-                                mail_body = append_to_mail_body(mail_body, f'Antal af dage er angivet til {days_written} i fakturalinjen, men ud fra startdato og slutdato udregnes antallet af dage fra {start_date.strftime("%d-%m-%Y")} til og med {end_date.strftime("%d-%m-%Y")} til at være {days_period} dage')
-                        mail_body = append_to_mail_body(mail_body, f'Du har fået tilsendt denne mail da du står som sagsbehandler på sagen inde i Vejman. Tilladelsen er angivet som værende type {equipment_type} under Materiel - med følgende fakturatekst: {Fakturalinje}.')
-
-                    
-                    short_start_date = start_date.strftime('%Y-%m-%d')
-                    short_end_date = chosen_end_date.strftime('%Y-%m-%d')
-                    
-                    merge_query = """
-                    MERGE INTO [dbo].[VejmanFakturering] AS target
-                    USING (SELECT ? AS VejmanFakturaID) AS source
-                    ON target.VejmanFakturaID = source.VejmanFakturaID
-                    WHEN MATCHED THEN
-                        UPDATE SET 
-                            Ansøger = ?, 
-                            FørsteSted = ?, 
-                            Tilladelsesnr = ?, 
-                            CvrNr = ?, 
-                            TilladelsesType = ?,
-                            Enhedspris = ?, 
-                            Meter = ?, 
-                            Startdato = ?, 
-                            Slutdato = ?,
-                            ATT = ?
-                    WHEN NOT MATCHED THEN
-                        INSERT (
-                            VejmanID, Ansøger, FørsteSted, Tilladelsesnr, CvrNr, TilladelsesType, 
-                            Enhedspris, Meter, Startdato, Slutdato, VejmanFakturaID, ATT
-                        )
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                    """
-
-                    # Execute the query
-                    with conn.cursor() as cursor:
-                        cursor.execute(
-                            merge_query,
-                            (
-                                # For source (to check if exists)
-                                VejmanFakturaID,
-                                
-                                # For update (if exists)
-                                applicant, address, tilladelse_nr, cvr_number, Fakturalinje, 
-                                unit_price, length, short_start_date, short_end_date, att,
-                                
-                                # For insert (if not exists)
-                                case_id, applicant, address, tilladelse_nr, cvr_number, Fakturalinje, 
-                                unit_price, length, short_start_date, short_end_date, VejmanFakturaID, att
-                            )
-                        )
-                        conn.commit()
-
-
-                    # Call the update_case function to send the data and verify the response
-                    # update_case(filtered_data, token)
-                if Matches == False:
-                    orchestrator_connection.log_info(f"No invoice line matches for {tilladelse_nr}")
-                    continue
-                    #mail_body = append_to_mail_body(mail_body, f'Der var intet match for følgende fakturalinje tekst i vejman: {detail_text} hvis materieltypen er {Fakturalinje}. Dette kan være fordi der er flere materieltyper på vejman tilladelsen <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a>, men tjek venligst efter om alt ser korrekt ud.')
-                if len(mail_body) > 0 and AlreadyCreated == False:
-                    mail_body = f'''Der er fundet uoverensstemmelser på fakturalinje(r) for tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a>. Ret dem til inde i Vejman, så bliver de automatisk opdateret i Vejmankassen næste dag medmindre de er slettet eller sendt til fakturering. Hvis datoerne er forkerte eller der er flere fakturalinjer pr. tilladelse skal de opdateres i <a href="https://vejmankassen.adm.aarhuskommune.dk/">Vejmankassen</a>. For at undgå spam får du kun denne mail en gang pr. fakturalinje, så du skal selv tjekke op på om alt er korrekt før du sender den til fakturering.<br><br>'''+mail_body
-                    SendEmail(caseworker_email,f"Uoverensstemmelser for fakturering på tilladelse {tilladelse_nr}", mail_body, developer_email)
-            else:
-                orchestrator_connection.log_info(f"No invoices found for case ID: {case_id}")
\ No newline at end of file
+                        mail_body = append_to_mail_body(mail_body, f'Antal af dage er angivet til {line.units} i fakturalinjen, men ud fra startdato og slutdato udregnes antallet af dage fra {start_date.strftime("%d-%m-%Y")} til og med {end_date.strftime("%d-%m-%Y")} til at være {line.days_period} dage')
+                mail_body = append_to_mail_body(mail_body, f'Du har fået tilsendt denne mail da du står som sagsbehandler på sagen inde i Vejman. Tilladelsen er angivet som værende type {equipment_type} under Materiel - med følgende fakturatekst: {Fakturalinje}.')
+
+            # Queue the line for the batched MERGE into [dbo].[VejmanFakturering]
+            writer.add({
+                "VejmanID": case_id,
+                "Ansøger": case['applicant'],
+                "FørsteSted": case['address'],
+                "Tilladelsesnr": tilladelse_nr,
+                "CvrNr": case['cvr_number'],
+                "TilladelsesType": Fakturalinje,
+                "Enhedspris": float(line.unit_price),
+                "Meter": float(line.length),
+                "Startdato": start_date.strftime('%Y-%m-%d'),
+                "Slutdato": chosen_end_date.strftime('%Y-%m-%d'),
+                "VejmanFakturaID": line.VejmanFakturaID,
+                "ATT": case['att'],
+            })
+
+        if len(mail_body) > 0 and not AlreadyCreated:
+            mail_body = f'''Der er fundet uoverensstemmelser på fakturalinje(r) for tilladelse <a href="https://vejman.vd.dk/permissions/update.jsp?caseid={case_id}">{tilladelse_nr}</a>. Ret dem til inde i Vejman, så bliver de automatisk opdateret i Vejmankassen næste dag medmindre de er slettet eller sendt til fakturering. Hvis datoerne er forkerte eller der er flere fakturalinjer pr. tilladelse skal de opdateres i <a href="https://vejmankassen.adm.aarhuskommune.dk/">Vejmankassen</a>. For at undgå spam får du kun denne mail en gang pr. fakturalinje, så du skal selv tjekke op på om alt er korrekt før du sender den til fakturering.<br><br>'''+mail_body
+            faktura_ids = [str(faktura_id) for faktura_id in group['VejmanFakturaID']] if group is not None else []
+            outbox.add(case['caseworker_email'], tilladelse_nr, mail_body, faktura_ids)
@@ -0,0 +1,80 @@
+"""This module contains the opt-in profiling of a run of the process, for diagnosing slow or bloated runs after the fact."""
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
+
+from robot_framework import config, metrics
+
+
+@contextmanager
+def profile_run(orchestrator_connection: OrchestratorConnection, label: str, cpu: bool = config.PROFILE, memory: bool = config.PROFILE_MEMORY):
+    """Profile the block with cProfile and/or trace its memory with tracemalloc.
+
+    The cProfile stats are written to PROFILE_DIR as a .prof file, which can be opened with
+    python -m pstats or snakeviz, next to a .txt report of the slowest functions. cProfile only sees
+    the thread running the block, so time spent in getcase worker threads shows up as waiting.
+    With memory the peak traced memory of the run and of each metrics timer is logged, and kept in the run metrics.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator used for logging where the profile is.
+        label: Names the profile files, e.g. the queue element.
+        cpu: Whether to run cProfile.
+        memory: Whether to run tracemalloc.
+    """
+    if not cpu and not memory:
+        yield
+        return
+
+    profiler = cProfile.Profile() if cpu else None
+    if memory:
+        tracemalloc.start()
+    peak = [0]
+    try:
+        with metrics.track_memory_peak() as peak:
+            if profiler:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler:
+                    profiler.disable()
+    finally:
+        if memory:
+            tracemalloc.stop()
+            _log_memory_peaks(orchestrator_connection, peak[0])
+        if profiler:
+            path = _write_profile(profiler, label)
+            orchestrator_connection.log_info(f"Profile written to {path}")
+
+
+def _write_profile(profiler: cProfile.Profile, label: str) -> str:
+    """Write the stats and a report of the PROFILE_TOP_FUNCTIONS slowest functions by cumulative time.
+
+    Returns:
+        str: The absolute path of the .prof file.
+    """
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{re.sub(r'[^A-Za-z0-9_-]+', '_', label)}"
+    path = os.path.abspath(os.path.join(config.PROFILE_DIR, f"{name}.prof"))
+    profiler.dump_stats(path)
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(config.PROFILE_TOP_FUNCTIONS)
+    with open(os.path.join(config.PROFILE_DIR, f"{name}.txt"), "w", encoding="utf-8") as file:
+        file.write(report.getvalue())
+    return path
+
+
+def _log_memory_peaks(orchestrator_connection: OrchestratorConnection, run_peak: int) -> None:
+    """Log the peak traced memory of the run and of each stage, largest first."""
+    peaks = sorted(metrics.current().memory_peaks.items(), key=lambda item: item[1], reverse=True)
+    stages = ", ".join(f"{name} {peak / 2 ** 20:.1f} MB" for name, peak in peaks)
+    orchestrator_connection.log_info(f"Peak traced memory {run_peak / 2 ** 20:.1f} MB" + (f": {stages}" if stages else ""))
@@ -11,8 +11,9 @@ from OpenOrchestrator.database.queues import QueueStatus
 from robot_framework import initialize
 from robot_framework import reset
 from robot_framework.exceptions import handle_error, BusinessError, log_exception
-from robot_framework import process
 from robot_framework import config
+from robot_framework.arguments import parse_process_arguments
+from robot_framework.profiling import profile_run
 
 
 def main():
@@ -23,6 +24,7 @@ def main():
     orchestrator_connection.log_trace("Robot Framework started.")
     initialize.initialize(orchestrator_connection)
 
+    arguments = parse_process_arguments(orchestrator_connection)
     queue_element = None
     error_count = 0
     task_count = 0
@@ -40,8 +42,12 @@ def main():
                     orchestrator_connection.log_info("Queue empty.")
                     break  # Break queue loop
 
+                # The process imports pandas, requests and pyodbc, so it is only loaded once there is work to do
+                from robot_framework import process  # pylint: disable=import-outside-toplevel
+
                 try:
-                    process.process(orchestrator_connection, queue_element)
+                    with profile_run(orchestrator_connection, f"element_{queue_element.id}", arguments.profile, arguments.profile_memory):
+                        process.process(orchestrator_connection, queue_element)
                     orchestrator_connection.set_queue_element_status(queue_element.id, QueueStatus.DONE)
 
                 except BusinessError as error:
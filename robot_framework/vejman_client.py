@@ -0,0 +1,174 @@
+"""This module contains the client used for every call to the Vejman API."""
+
+import random
+import threading
+import time
+from collections.abc import Callable
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from robot_framework import config, metrics
+from robot_framework.adaptive_limit import AdaptiveLimit
+
+# The fixed query parameters of the getcases permission list.
+_GETCASES_PARAMS = {
+    "pmCaseStates": "8",
+    "pmCaseFields": "state,type,case_number,authority_reference_number,start_date,street_name,cvr_number,applicant,end_date,completion_date,auto_completedcontractor,initials",
+    "pmCaseWorker": "all",
+    "pmCaseTypes": "'rovm'",
+    "pmCaseVariant": "all",
+    "pmCaseTags": "ignorerTags",
+    "pmCaseTagShow": "",
+    "pmCaseShowAttachments": "false",
+    "pmAllStates": "",
+    "dontincludemap": "1",
+    "authority": "751",
+    "cse": "",
+}
+
+# Responses that are retried, besides timeouts and connection errors.
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:  # pylint: disable=too-few-public-methods
+    """A thread safe token bucket limiting the rate of requests.
+    Up to `capacity` requests can be sent at once, refilled at `rate` requests per second.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Wait until a request may be sent."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class VejmanClient:
+    """A pooled keep-alive session to Vejman with per endpoint timeouts, retries with jittered
+    exponential backoff, a shared rate limit and an adaptive limit on the requests in flight.
+    The token is added to every request and removed from the URL in error messages.
+    """
+
+    def __init__(self, token: str, base_url: str | None = None, pool_size: int = config.GETCASE_WORKERS + 1,
+                 log: Callable[[str], None] | None = None):
+        """
+        Args:
+            token: The Vejman token.
+            base_url: The Vejman URL without a trailing slash, VEJMAN_BASE_URL by default.
+            pool_size: The number of connections kept open, at least the number of concurrent requests.
+            log: Called with the concurrency and throttling events of the client.
+        """
+        self.token = token
+        self.base_url = base_url or config.VEJMAN_BASE_URL
+        self.retry_count = 0
+        self._bucket = TokenBucket(config.VEJMAN_RATE_LIMIT, config.VEJMAN_RATE_BURST)
+        self.limit = AdaptiveLimit(log)
+
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        """Close the pooled connections."""
+        self.session.close()
+
+    def get(self, path: str, params: dict, endpoint: str, stream: bool = False, headers: dict | None = None) -> requests.Response:
+        """Send a GET request, retrying timeouts, connection errors and 429/5xx responses.
+
+        Args:
+            path: The path of the endpoint, e.g. "/permissions/getcase".
+            params: The query parameters besides the token.
+            endpoint: The key of the endpoint in VEJMAN_TIMEOUTS.
+            stream: Whether to stream the response body.
+            headers: Extra request headers.
+
+        Returns:
+            requests.Response: The response. 304 Not Modified is returned, other 4xx/5xx responses raise.
+
+        Raises:
+            requests.HTTPError: If the final response is an error.
+            requests.RequestException: If the final attempt times out or cannot connect.
+        """
+        url = f"{self.base_url}{path}"
+        params = {**params, "token": self.token}
+
+        for attempt in range(config.VEJMAN_RETRIES + 1):
+            self._bucket.acquire()
+            self.limit.acquire()
+            started = time.monotonic()
+            response = None
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=config.VEJMAN_TIMEOUTS[endpoint], stream=stream)
+            except (requests.Timeout, requests.ConnectionError) as error:
+                if attempt == config.VEJMAN_RETRIES:
+                    # urllib3 puts the whole query string in the message, so raise a copy without the token
+                    raise type(error)(f"{type(error).__name__} for {url} ({endpoint})") from None
+            finally:
+                # A streamed response frees its slot once the headers have arrived
+                success = response is not None and response.status_code not in _RETRY_STATUSES
+                latency = time.monotonic() - started
+                self.limit.release(success, latency, config.VEJMAN_LATENCY_TARGETS.get(endpoint))
+                metrics.observe(f"http_{endpoint}", latency)
+                if not success:
+                    metrics.count(f"http_{endpoint}_errors")
+
+            if response is not None:
+                if response.status_code not in _RETRY_STATUSES or attempt == config.VEJMAN_RETRIES:
+                    break
+                response.close()
+            self.retry_count += 1
+            metrics.count("http_retries")
+            time.sleep(random.uniform(0, min(config.VEJMAN_BACKOFF_MAX, config.VEJMAN_BACKOFF_BASE * 2 ** attempt)))
+
+        if response.status_code >= 400:
+            response.close()
+            raise requests.HTTPError(f"{response.status_code} {response.reason} for {url} ({endpoint})", response=response)
+        return response
+
+    def get_cases(self, equipment_type, start_date_from, end_date_from, stream: bool = False) -> requests.Response:
+        """Get the getcases permission list of an equipment type that started after start_date_from
+        and ended after end_date_from. Use the response as a context manager when streaming.
+        """
+        params = {
+            **_GETCASES_PARAMS,
+            "equipmentType": equipment_type,
+            "startDateFrom": start_date_from,
+            "startDateTo": datetime.today().strftime('%Y-%m-%d'),
+            "endDateFrom": end_date_from,
+            "policeDistrictShow": "",
+            "_": int(time.time() * 1000),
+        }
+        return self.get("/permissions/getcases", params, "getcases", stream=stream)
+
+    def get_case(self, case_id) -> dict | None:
+        """Get the getcase details of a case."""
+        return self.get("/permissions/getcase", {"caseid": case_id}, "getcase").json().get('data')
+
+    def get_pricebook(self, headers: dict | None = None) -> requests.Response:
+        """Get the v_h_pm_pricebook table, optionally as a conditional request."""
+        return self.get("/services/data.do", {"table": "v_h_pm_pricebook"}, "pricebook", headers=headers)